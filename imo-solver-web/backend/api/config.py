@@ -2,10 +2,14 @@
 配置API路由
 """
 from fastapi import APIRouter, HTTPException
-from pydantic import BaseModel, Field
-from typing import Dict, Optional
+from pydantic import BaseModel, ConfigDict, Field
+from typing import Dict, Optional, Tuple
 import os
 import json
+import time
+import asyncio
+import hashlib
+import orjson
 import logging
 
 logger = logging.getLogger(__name__)
@@ -15,8 +19,18 @@ router = APIRouter()
 # 配置文件路径
 CONFIG_FILE = "config.json"
 
+# 已加载的配置缓存: (文件的st_mtime_ns, 配置内容)
+_config_cache: Optional[Tuple[int, Dict]] = None
+
+# API密钥验证结果缓存: 密钥哈希+模型 -> (验证时间, 结果)
+VALIDATION_CACHE_TTL = 60
+_validation_cache: Dict[str, Tuple[float, Dict]] = {}
+
 class ConfigModel(BaseModel):
     """配置模型"""
+    # 忽略配置文件中的额外字段（如api_key）
+    model_config = ConfigDict(extra="ignore")
+    
     default_model: str = Field("claude-3.5-sonnet", description="默认模型")
     default_num_agents: int = Field(10, description="默认代理数量")
     default_timeout: Optional[int] = Field(None, description="默认超时时间")
@@ -24,13 +38,24 @@ class ConfigModel(BaseModel):
     api_key_hint: Optional[str] = Field(None, description="API密钥提示（仅显示前后几位）")
 
 def load_config() -> Dict:
-    """加载配置"""
-    if os.path.exists(CONFIG_FILE):
-        try:
-            with open(CONFIG_FILE, 'r') as f:
-                return json.load(f)
-        except Exception as e:
-            logger.error(f"Error loading config: {e}")
+    """加载配置（文件未修改时直接返回缓存）"""
+    global _config_cache
+    try:
+        mtime_ns = os.stat(CONFIG_FILE).st_mtime_ns
+    except FileNotFoundError:
+        _config_cache = None
+        return {}
+    
+    if _config_cache is not None and _config_cache[0] == mtime_ns:
+        return dict(_config_cache[1])
+    
+    try:
+        with open(CONFIG_FILE, 'rb') as f:
+            config = orjson.loads(f.read())
+        _config_cache = (mtime_ns, config)
+        return dict(config)
+    except Exception as e:
+        logger.error(f"Error loading config: {e}")
     return {}
 
 def save_config(config: Dict):
@@ -53,13 +78,13 @@ async def get_config():
         if len(key) > 8:
             config["api_key_hint"] = f"{key[:4]}...{key[-4:]}"
     
-    return ConfigModel(**config)
+    return ConfigModel.model_validate(config)
 
 @router.put("/")
 async def update_config(config: ConfigModel):
     """更新配置"""
     try:
-        config_dict = config.dict(exclude_none=True)
+        config_dict = config.model_dump(exclude_none=True)
         
         # 不保存API密钥提示
         if "api_key_hint" in config_dict:
@@ -77,24 +102,37 @@ async def validate_api_key(api_key: str, model: str = "openai/gpt-3.5-turbo"):
     """
     from core.openrouter_adapter import OpenRouterAdapter
     
+    cache_key = hashlib.sha256(api_key.encode()).hexdigest()[:16] + model
+    cached = _validation_cache.get(cache_key)
+    if cached is not None and time.monotonic() - cached[0] < VALIDATION_CACHE_TTL:
+        return cached[1]
+    
     try:
         adapter = OpenRouterAdapter(api_key=api_key, model=model)
         
-        # 尝试一个简单的API调用
-        response = adapter.call_api(
+        # 尝试一个简单的API调用（在线程中执行，避免阻塞事件循环）
+        response = await asyncio.to_thread(
+            adapter.call_api,
             system_prompt="You are a helpful assistant.",
             user_prompt="Say 'Hello' in one word.",
             max_tokens=10
         )
         
         if response:
-            return {"valid": True, "message": "API key is valid"}
+            result = {"valid": True, "message": "API key is valid"}
         else:
-            return {"valid": False, "message": "API key validation failed"}
+            result = {"valid": False, "message": "API key validation failed"}
             
     except Exception as e:
         logger.error(f"API key validation error: {e}")
-        return {"valid": False, "message": str(e)}
+        result = {"valid": False, "message": str(e)}
+    
+    now = time.monotonic()
+    # 顺便清理过期的缓存项
+    for key in [k for k, (ts, _) in _validation_cache.items() if now - ts >= VALIDATION_CACHE_TTL]:
+        del _validation_cache[key]
+    _validation_cache[cache_key] = (now, result)
+    return result
 
 @router.get("/sample-problems")
 async def get_sample_problems():
@@ -5,7 +5,6 @@ from fastapi import APIRouter, HTTPException, BackgroundTasks
 from pydantic import BaseModel, Field
 from typing import List, Optional, Dict
 import uuid
-import json
 import logging
 
 from core.solver_manager import SolverManager
@@ -26,6 +25,7 @@ class SolveRequest(BaseModel):
     other_prompts: List[str] = Field(default_factory=list, description="额外提示词")
     timeout: Optional[int] = Field(None, ge=60, le=3600, description="超时时间（秒）")
     max_iterations: int = Field(30, ge=1, le=100, description="最大迭代次数")
+    skip_self_improvement_if_correct: bool = Field(True, description="初始解答通过验证时跳过自我改进")
     client_id: str = Field(..., description="WebSocket客户端ID")
 
 class SolveResponse(BaseModel):
@@ -52,7 +52,8 @@ async def start_solve(request: SolveRequest, background_tasks: BackgroundTasks):
             api_key=request.api_key,
             other_prompts=request.other_prompts,
             timeout=request.timeout,
-            max_iterations=request.max_iterations
+            max_iterations=request.max_iterations,
+            skip_self_improvement_if_correct=request.skip_self_improvement_if_correct
         )
         
         # 注册WebSocket回调（如果提供了client_id）
@@ -61,12 +62,14 @@ async def start_solve(request: SolveRequest, background_tasks: BackgroundTasks):
             
             # 创建WebSocket回调函数
             async def websocket_callback(message):
-                # 发送消息到特定客户端
-                logger.info(f"Sending WebSocket message to {request.client_id}: {message.get('type')}")
-                await manager.send_personal_message(
-                    json.dumps(message),
-                    request.client_id
-                )
+                # 发送消息到特定客户端，列表为一组合并发送的消息（逐条消息的日志只在DEBUG级别输出）
+                if isinstance(message, list):
+                    logger.debug("Sending %d WebSocket messages to %s", len(message), request.client_id)
+                    await manager.send_multi(request.client_id, message)
+                    return
+                if logger.isEnabledFor(logging.DEBUG):
+                    logger.debug("Sending WebSocket message to %s: %s", request.client_id, message.get('type'))
+                await manager.send_message(message, request.client_id)
             
             # 注册回调
             solver_manager.register_websocket_callback(task_id, websocket_callback)
@@ -92,6 +95,9 @@ async def get_task_status(task_id: str):
     获取任务状态
     """
     status = solver_manager.get_task_status(task_id)
+    if status is None and solver_manager.state_store:
+        # 任务可能由其他worker运行
+        status = await solver_manager.state_store.get_task_status(task_id)
     if status is None:
         raise HTTPException(status_code=404, detail="Task not found")
     return status
@@ -128,12 +134,9 @@ async def list_tasks():
     """
     列出所有任务
     """
-    tasks = []
-    for task_id in solver_manager.tasks:
-        status = solver_manager.get_task_status(task_id)
-        if status:
-            tasks.append(status)
-    return {"tasks": tasks}
+    if solver_manager.state_store:
+        return {"tasks": await solver_manager.state_store.list_task_status()}
+    return {"tasks": solver_manager.get_all_task_status()}
 
 @router.delete("/task/{task_id}")
 async def delete_task(task_id: str):
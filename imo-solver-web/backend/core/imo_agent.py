@@ -5,11 +5,15 @@ IMO问题求解代理（支持OpenRouter和WebSocket更新）
 import asyncio
 import json
 import logging
-from typing import Optional, Dict, List, Callable
+import re
+import time
+from collections import deque
+from typing import Optional, Dict, List, Callable, Deque
 from dataclasses import dataclass, field
 from enum import Enum
 
 from .openrouter_adapter import OpenRouterAdapter
+from .verification_batcher import VerificationBatcher
 from .prompts import (
     STEP1_PROMPT,
     SELF_IMPROVEMENT_PROMPT,
@@ -20,6 +24,37 @@ from .prompts import (
 
 logger = logging.getLogger(__name__)
 
+# 每个代理在内存中保留的日志条数（完整日志已通过WebSocket推送）
+MAX_RETAINED_LOGS = 200
+
+# yes/no判定：只匹配开头的yes（允许前导空白、引号、加粗等符号）
+_YES_RE = re.compile(r'^\W*yes\b', re.IGNORECASE)
+
+def _is_yes(text: str) -> bool:
+    """判断回复是否为肯定回答"""
+    return _YES_RE.match(text) is not None
+
+# 解答完整性的判断：读取Summary中Verdict的第一句（STEP1_PROMPT要求在此声明完整或部分解答），
+# 含有否定词或partial时视为不完整；解答短于最短长度时也视为不完整
+_VERDICT_RE = re.compile(r'Verdict[^\w\n]*\n?\s*([^\n]*?)(?:\.\s|\.?$)', re.IGNORECASE | re.MULTILINE)
+_COMPLETE_RE = re.compile(r'\bcomplete\b', re.IGNORECASE)
+_NOT_COMPLETE_RE = re.compile(r"\b(not|no|never|cannot|unable|fail\w*|incomplete|partial\w*)\b|n't\b", re.IGNORECASE)
+MIN_COMPLETE_SOLUTION_LENGTH = 500
+
+# 通过WebSocket发送解答时每个分片的大小（字符）
+SOLUTION_CHUNK_SIZE = 8 * 1024
+
+# 连续验证失败达到该次数时停止求解
+MAX_CONSECUTIVE_ERRORS = 10
+
+# 生成调用的温度在模型默认温度上按代理ID递增，使各代理的生成请求互不相同，
+# 不会被合并为同一个进行中的请求，各自保持独立的求解轨迹
+AGENT_TEMPERATURE_STEP = 0.01
+
+# 日志批量发送的延迟（秒，从缓冲区的第一条日志开始计时）和单批最大条数
+LOG_FLUSH_INTERVAL = 0.05
+LOG_BATCH_MAX_SIZE = 50
+
 class AgentStatus(Enum):
     """代理状态枚举"""
     PENDING = "pending"
@@ -28,7 +63,7 @@ class AgentStatus(Enum):
     SUCCESS = "success"
     FAILED = "failed"
 
-@dataclass
+@dataclass(slots=True)
 class AgentState:
     """代理状态"""
     agent_id: int
@@ -38,7 +73,7 @@ class AgentState:
     correct_count: int = 0
     error_count: int = 0
     solution: Optional[str] = None
-    logs: List[Dict] = field(default_factory=list)
+    logs: Deque[Dict] = field(default_factory=lambda: deque(maxlen=MAX_RETAINED_LOGS))
     start_time: float = 0
     end_time: float = 0
 
@@ -49,13 +84,35 @@ class IMOAgent:
         self,
         agent_id: int,
         api_adapter: OpenRouterAdapter,
-        websocket_callback: Optional[Callable] = None
+        websocket_callback: Optional[Callable] = None,
+        api_semaphore: Optional[asyncio.Semaphore] = None,
+        status_listener: Optional[Callable] = None,
+        verification_batcher: Optional[VerificationBatcher] = None,
+        skip_self_improvement_if_correct: bool = True
     ):
         self.agent_id = agent_id
         self.api = api_adapter
         self.websocket_callback = websocket_callback
+        # 多个代理共享的信号量，用于限制同时进行的API调用数量
+        self.api_semaphore = api_semaphore
+        # 状态变化监听器，调用方式: status_listener(agent, old_status, new_status)
+        self.status_listener = status_listener
+        # 同一任务内各代理共享的验证请求合并器
+        self.verification_batcher = verification_batcher
+        # 初始解答已通过验证时跳过自我改进
+        self.skip_self_improvement_if_correct = skip_self_improvement_if_correct
         self.state = AgentState(agent_id=agent_id)
+        # 生成（初始解答、自我改进、修正）调用使用的温度
+        self.temperature = round(api_adapter.config.temperature + agent_id * AGENT_TEMPERATURE_STEP, 3)
         self.conversation_history = []
+        # 待发送的日志缓冲区，第一条日志写入时安排一次延迟发送（_flush_later）
+        self._log_buffer: List[Dict] = []
+        self._flush_task: Optional[asyncio.Task] = None
+        # 最近一次未通过验证的解答哈希及其验证结果，解答未变化时无需重新验证
+        self._last_verified_hash: Optional[int] = None
+        self._last_verify: Optional[tuple] = None
+        # (问题陈述, 验证提示中的问题部分)，在solve开始时构建
+        self._problem_header: Optional[tuple] = None
     
     async def log(self, level: str, message: str):
         """记录日志并发送WebSocket更新"""
@@ -64,38 +121,90 @@ class IMOAgent:
         log_entry = {
             "level": level,
             "message": message,
-            "timestamp": asyncio.get_event_loop().time()
+            "timestamp": time.monotonic()
         }
         self.state.logs.append(log_entry)
         
         if self.websocket_callback:
-            await self.websocket_callback({
-                "type": "log",
-                "agent_id": self.agent_id,
+            self._log_buffer.append({
                 "level": level,
                 "message": message
             })
+            if len(self._log_buffer) >= LOG_BATCH_MAX_SIZE:
+                await self.flush_logs()
+            elif self._flush_task is None:
+                self._flush_task = asyncio.create_task(self._flush_later())
+    
+    async def flush_logs(self):
+        """将缓冲的日志合并为一条log_batch消息发送"""
+        if self._flush_task is not None:
+            self._flush_task.cancel()
+            self._flush_task = None
+        if not self._log_buffer or not self.websocket_callback:
+            return
+        entries = self._log_buffer
+        self._log_buffer = []
+        await self.websocket_callback({
+            "type": "log_batch",
+            "agent_id": self.agent_id,
+            "entries": entries
+        })
     
-    async def update_status(self, status: AgentStatus, current_step: str = ""):
-        """更新代理状态"""
+    async def _flush_later(self):
+        """等待LOG_FLUSH_INTERVAL后发送缓冲的日志；缓冲区为空时不安排，空闲的代理不会定期唤醒"""
+        await asyncio.sleep(LOG_FLUSH_INTERVAL)
+        self._flush_task = None
+        await self.flush_logs()
+    
+    async def update_status(self, status: AgentStatus, current_step: str = "", notify: bool = True):
+        """更新代理状态；notify=False时不发送WebSocket更新（由调用方用status_message合并发送）"""
+        old_status = self.state.status
         self.state.status = status
         if current_step:
             self.state.current_step = current_step
         
+        if self.status_listener:
+            self.status_listener(self, old_status, status)
+        
         logger.info(f"[Agent {self.agent_id}] Status update: {status.value}, step: {current_step}, has_callback: {self.websocket_callback is not None}")
         
-        if self.websocket_callback:
+        if notify and self.websocket_callback:
+            await self.websocket_callback(self.status_message())
+    
+    def status_message(self) -> Dict:
+        """当前状态的agent_update消息"""
+        return {
+            "type": "agent_update",
+            "agent_id": self.agent_id,
+            "status": self.state.status.value,
+            "data": {
+                "current_step": self.state.current_step,
+                "iteration": self.state.iteration,
+                "correct_count": self.state.correct_count,
+                "error_count": self.state.error_count
+            }
+        }
+    
+    async def send_solution(self, solution: str):
+        """将解答分片发送（solution_chunk消息），最后发送solution_end"""
+        seq = 0
+        for start in range(0, len(solution), SOLUTION_CHUNK_SIZE):
             await self.websocket_callback({
-                "type": "agent_update",
+                "type": "solution_chunk",
                 "agent_id": self.agent_id,
-                "status": status.value,
-                "data": {
-                    "current_step": self.state.current_step,
-                    "iteration": self.state.iteration,
-                    "correct_count": self.state.correct_count,
-                    "error_count": self.state.error_count
-                }
+                "seq": seq,
+                "data": solution[start:start + SOLUTION_CHUNK_SIZE]
             })
+            seq += 1
+        await self.websocket_callback({
+            "type": "solution_end",
+            "agent_id": self.agent_id,
+            "chunks": seq
+        })
+    
+    async def call_api(self, **kwargs) -> Dict:
+        """调用API，受共享信号量的并发限制"""
+        return await self.api.acall_api(semaphore=self.api_semaphore, **kwargs)
     
     def extract_detailed_solution(self, solution: str, marker: str = 'Detailed Solution', after: bool = True) -> str:
         """提取详细解答部分"""
@@ -104,17 +213,12 @@ class IMOAgent:
             return ''
         if after:
             return solution[idx + len(marker):].strip()
-        else:
-            return solution[:idx].strip()
+        return solution[:idx].strip()
     
-    async def verify_solution(self, problem_statement: str, solution: str) -> tuple:
-        """验证解答的正确性"""
-        await self.update_status(AgentStatus.VERIFYING, "验证解答正确性")
-        await self.log("info", "开始验证解答")
-        
-        detailed_solution = self.extract_detailed_solution(solution)
-        
-        verification_prompt = f"""
+    def _get_problem_header(self, problem_statement: str) -> str:
+        """获取验证提示中问题部分的固定前缀（每个问题只构建一次）"""
+        if self._problem_header is None or self._problem_header[0] != problem_statement:
+            header = f"""
 ======================================================================
 ### Problem ###
 
@@ -123,14 +227,35 @@ class IMOAgent:
 ======================================================================
 ### Solution ###
 
-{detailed_solution}
-
-{VERIFICATION_REMINDER}
 """
+            self._problem_header = (problem_statement, header)
+        return self._problem_header[1]
+    
+    async def verify_solution(self, problem_statement: str, solution: str) -> tuple:
+        """验证解答的正确性"""
+        await self.update_status(AgentStatus.VERIFYING, "验证解答正确性")
+        await self.log("info", "开始验证解答")
+        
+        detailed_solution = self.extract_detailed_solution(solution)
+        
+        if self.verification_batcher is not None:
+            # 与其他代理的验证请求合并为一次API调用
+            batched = await self.verification_batcher.verify(detailed_solution)
+            if batched is not None:
+                bug_report, check_result = batched
+                self._remember_verification(solution, bug_report, check_result)
+                is_correct = check_result == "yes"
+                await self.log(
+                    "info" if is_correct else "warning",
+                    f"验证结果: {'通过' if is_correct else '未通过'}"
+                )
+                return bug_report, check_result
+        
+        verification_prompt = f"{self._get_problem_header(problem_statement)}{detailed_solution}\n\n{VERIFICATION_REMINDER}\n"
         
         try:
             # 调用API进行验证
-            response = self.api.call_api(
+            response = await self.call_api(
                 system_prompt=VERIFICATION_SYSTEM_PROMPT,
                 user_prompt=verification_prompt
             )
@@ -138,18 +263,14 @@ class IMOAgent:
             
             await self.log("info", "验证完成，检查结果")
             
-            # 检查验证是否通过
-            check_prompt = f"""Response in "yes" or "no". Is the following statement saying the solution is correct, or does not contain critical error or a major justification gap?
-
-{verification_result}"""
+            # 从最后一行的FINAL_VERDICT读取验证结论，无需再次调用API
+            verdict_idx = verification_result.rfind("FINAL_VERDICT:")
+            verdict = ""
+            if verdict_idx != -1:
+                verdict = verification_result[verdict_idx + len("FINAL_VERDICT:"):]
+            check_result = "yes" if _is_yes(verdict) else "no"
             
-            check_response = self.api.call_api(
-                system_prompt="",
-                user_prompt=check_prompt
-            )
-            check_result = self.api.extract_response_text(check_response)
-            
-            is_correct = "yes" in check_result.lower()
+            is_correct = _is_yes(check_result)
             
             # 提取错误报告
             bug_report = ""
@@ -160,6 +281,7 @@ class IMOAgent:
                     False
                 )
             
+            self._remember_verification(solution, bug_report, check_result)
             await self.log(
                 "info" if is_correct else "warning",
                 f"验证结果: {'通过' if is_correct else '未通过'}"
@@ -168,30 +290,55 @@ class IMOAgent:
             return bug_report, check_result
             
         except Exception as e:
+            # 出错的结果不记录，解答不变时下次仍重新验证
             await self.log("error", f"验证过程出错: {e}")
             return str(e), "no"
     
+    def release(self):
+        """求解结束后释放对话历史、日志等较大的对象，仅保留状态摘要"""
+        self.conversation_history = []
+        self.state.logs.clear()
+        self._last_verify = None
+        self._problem_header = None
+    
+    def _remember_verification(self, solution: str, verify: str, good_verify: str):
+        """记录未通过的验证结果；通过的验证不复用，需要独立的再次验证"""
+        if _is_yes(good_verify):
+            self._last_verified_hash = None
+            self._last_verify = None
+        else:
+            self._last_verified_hash = hash(solution)
+            self._last_verify = (verify, good_verify)
+    
     async def check_if_solution_complete(self, solution: str) -> bool:
-        """检查解答是否声称完整"""
-        check_prompt = f"""Is the following text claiming that the solution is complete?
-==========================================================
-
-{solution}
-
-==========================================================
-
-Response in exactly "yes" or "no". No other words."""
-        
-        try:
-            response = self.api.call_api(
-                system_prompt="",
-                user_prompt=check_prompt
-            )
-            result = self.api.extract_response_text(response)
-            return "yes" in result.lower()
-        except Exception as e:
-            await self.log("error", f"检查完整性出错: {e}")
+        """检查解答是否声称完整（根据Summary中的Verdict判断，无需调用API）"""
+        if len(solution) <= MIN_COMPLETE_SOLUTION_LENGTH:
+            return False
+        match = _VERDICT_RE.search(solution)
+        if match is None:
             return False
+        verdict = match.group(1)
+        return _COMPLETE_RE.search(verdict) is not None and _NOT_COMPLETE_RE.search(verdict) is None
+    
+    async def _self_improve(self, output1: str) -> str:
+        """对初始解答进行自我改进"""
+        await self.update_status(AgentStatus.RUNNING, "自我改进")
+        self.conversation_history = [
+            {"role": "assistant", "content": output1},
+            {"role": "user", "content": SELF_IMPROVEMENT_PROMPT}
+        ]
+        
+        response = await self.call_api(
+            system_prompt=STEP1_PROMPT,
+            user_prompt=SELF_IMPROVEMENT_PROMPT,
+            conversation_history=[{"role": "assistant", "content": output1}],
+            temperature=self.temperature,
+            stream=True
+        )
+        solution = self.api.extract_response_text(response)
+        
+        await self.log("info", "自我改进完成")
+        return solution
     
     async def initial_exploration(self, problem_statement: str, other_prompts: List[str] = None) -> tuple:
         """初始探索阶段"""
@@ -205,29 +352,30 @@ Response in exactly "yes" or "no". No other words."""
         try:
             # 第一次尝试
             await self.update_status(AgentStatus.RUNNING, "生成初始解答")
-            response1 = self.api.call_api(
+            response1 = await self.call_api(
                 system_prompt=STEP1_PROMPT,
-                user_prompt="\n\n".join(user_prompts)
+                user_prompt="\n\n".join(user_prompts),
+                temperature=self.temperature,
+                stream=True
             )
             output1 = self.api.extract_response_text(response1)
             
             await self.log("info", "初始解答生成完成")
             
-            # 自我改进
-            await self.update_status(AgentStatus.RUNNING, "自我改进")
-            self.conversation_history = [
-                {"role": "assistant", "content": output1},
-                {"role": "user", "content": SELF_IMPROVEMENT_PROMPT}
-            ]
-            
-            response2 = self.api.call_api(
-                system_prompt=STEP1_PROMPT,
-                user_prompt=SELF_IMPROVEMENT_PROMPT,
-                conversation_history=[{"role": "assistant", "content": output1}]
-            )
-            solution = self.api.extract_response_text(response2)
-            
-            await self.log("info", "自我改进完成")
+            # 自我改进与初始解答的验证并发执行（初始解答看起来完整时），验证通过则取消自我改进
+            improve_task = asyncio.create_task(self._self_improve(output1))
+            try:
+                if self.skip_self_improvement_if_correct and await self.check_if_solution_complete(output1):
+                    verify, good_verify = await self.verify_solution(problem_statement, output1)
+                    if _is_yes(good_verify):
+                        await self.log("info", "初始解答已通过验证，跳过自我改进")
+                        self.conversation_history = [{"role": "assistant", "content": output1}]
+                        return self.conversation_history, output1, verify, good_verify
+                
+                solution = await improve_task
+            finally:
+                if not improve_task.done():
+                    improve_task.cancel()
             
             # 检查完整性
             is_complete = await self.check_if_solution_complete(solution)
@@ -256,7 +404,16 @@ Response in exactly "yes" or "no". No other words."""
         Returns:
             解答文本，如果失败则返回None
         """
-        self.state.start_time = asyncio.get_event_loop().time()
+        try:
+            return await self._solve(problem_statement, other_prompts, max_iterations)
+        finally:
+            # 确保剩余日志在返回前发送（同时取消已安排的延迟发送）
+            await self.flush_logs()
+    
+    async def _solve(self, problem_statement: str, other_prompts: List[str], max_iterations: int) -> Optional[str]:
+        """求解主流程"""
+        self.state.start_time = time.monotonic()
+        self._get_problem_header(problem_statement)
         await self.update_status(AgentStatus.RUNNING, "开始求解")
         await self.log("info", f"开始求解IMO问题，最大迭代次数: {max_iterations}")
         
@@ -268,7 +425,7 @@ Response in exactly "yes" or "no". No other words."""
         if solution is None:
             await self.log("error", "初始探索失败，未找到完整解答")
             await self.update_status(AgentStatus.FAILED, "初始探索失败")
-            self.state.end_time = asyncio.get_event_loop().time()
+            self.state.end_time = time.monotonic()
             return None
         
         # 迭代改进
@@ -276,7 +433,7 @@ Response in exactly "yes" or "no". No other words."""
             self.state.iteration = i + 1
             await self.log("info", f"迭代 {i+1}/{max_iterations}, 正确次数: {self.state.correct_count}, 错误次数: {self.state.error_count}")
             
-            if "yes" not in good_verify.lower():
+            if not _is_yes(good_verify):
                 # 验证未通过，需要修正
                 self.state.correct_count = 0
                 self.state.error_count += 1
@@ -284,17 +441,13 @@ Response in exactly "yes" or "no". No other words."""
                 await self.update_status(AgentStatus.RUNNING, f"修正错误 (迭代 {i+1})")
                 await self.log("warning", "验证未通过，开始修正")
                 
-                # 构建修正提示
-                correction_messages = [
-                    {"role": "assistant", "content": solution},
-                    {"role": "user", "content": f"{CORRECTION_PROMPT}\n\n{verify}"}
-                ]
-                
                 try:
-                    response = self.api.call_api(
+                    response = await self.call_api(
                         system_prompt=STEP1_PROMPT,
                         user_prompt=f"{CORRECTION_PROMPT}\n\n{verify}",
-                        conversation_history=[{"role": "assistant", "content": solution}]
+                        conversation_history=[{"role": "assistant", "content": solution}],
+                        temperature=self.temperature,
+                        stream=True
                     )
                     solution = self.api.extract_response_text(response)
                     
@@ -308,10 +461,14 @@ Response in exactly "yes" or "no". No other words."""
                     await self.log("error", f"修正过程出错: {e}")
                     continue
             
-            # 验证解答
-            verify, good_verify = await self.verify_solution(problem_statement, solution)
+            # 验证解答（解答与上次未通过验证的版本相同时直接沿用结果）
+            if hash(solution) == self._last_verified_hash:
+                await self.log("info", "解答未变化，沿用上次的验证结果")
+                verify, good_verify = self._last_verify
+            else:
+                verify, good_verify = await self.verify_solution(problem_statement, solution)
             
-            if "yes" in good_verify.lower():
+            if _is_yes(good_verify):
                 self.state.correct_count += 1
                 self.state.error_count = 0
                 await self.log("info", f"验证通过 ({self.state.correct_count}/5)")
@@ -321,24 +478,20 @@ Response in exactly "yes" or "no". No other words."""
                     await self.log("info", "成功找到正确解答！")
                     await self.update_status(AgentStatus.SUCCESS, "找到正确解答")
                     self.state.solution = solution
-                    self.state.end_time = asyncio.get_event_loop().time()
+                    self.state.end_time = time.monotonic()
                     
                     if self.websocket_callback:
-                        await self.websocket_callback({
-                            "type": "solution_found",
-                            "agent_id": self.agent_id,
-                            "solution": solution
-                        })
+                        await self.send_solution(solution)
                     
                     return solution
             
             # 检查失败条件
-            if self.state.error_count >= 10:
+            if self.state.error_count >= MAX_CONSECUTIVE_ERRORS:
                 await self.log("error", "连续错误次数过多，停止求解")
                 break
         
         # 求解失败
         await self.log("error", "未能找到正确解答")
         await self.update_status(AgentStatus.FAILED, "求解失败")
-        self.state.end_time = asyncio.get_event_loop().time()
+        self.state.end_time = time.monotonic()
         return None
\ No newline at end of file
@@ -2,15 +2,135 @@
 OpenRouter API适配器
 将原Gemini API调用转换为OpenRouter API调用
 """
+import asyncio
+import functools
+import hashlib
 import requests
-import json
+import httpx
+import orjson
 import time
 import logging
-from typing import Dict, List, Optional, Any
+import random
+import threading
+from typing import Dict, List, Optional, Any, Tuple, AsyncIterator
 from dataclasses import dataclass
+from requests.adapters import HTTPAdapter
 
 logger = logging.getLogger(__name__)
 
+# 所有适配器共享的异步HTTP客户端（懒加载），复用TLS连接并支持HTTP/2多路复用
+_shared_client: Optional[httpx.AsyncClient] = None
+
+def get_shared_client() -> httpx.AsyncClient:
+    """获取所有适配器共享的异步HTTP客户端"""
+    global _shared_client
+    if _shared_client is None or _shared_client.is_closed:
+        _shared_client = httpx.AsyncClient(
+            http2=True,
+            timeout=httpx.Timeout(120.0, connect=10.0),  # 2分钟超时
+            limits=httpx.Limits(max_connections=200, max_keepalive_connections=50)
+        )
+    return _shared_client
+
+async def close_shared_client():
+    """关闭共享的异步HTTP客户端"""
+    global _shared_client
+    if _shared_client is not None:
+        await _shared_client.aclose()
+        _shared_client = None
+
+# 同步调用共享的requests会话（懒加载），复用keep-alive连接
+_shared_session: Optional[requests.Session] = None
+_shared_session_lock = threading.Lock()
+
+def get_shared_session() -> requests.Session:
+    """获取同步调用共享的requests会话"""
+    global _shared_session
+    if _shared_session is None:
+        with _shared_session_lock:
+            if _shared_session is None:
+                session = requests.Session()
+                session.mount("https://", HTTPAdapter(pool_connections=32, pool_maxsize=32, max_retries=0))
+                _shared_session = session
+    return _shared_session
+
+class _InflightRequest:
+    """进行中的请求及其等待者数量"""
+    __slots__ = ("task", "waiters")
+
+    def __init__(self, task: asyncio.Task):
+        self.task = task
+        self.waiters = 0
+
+# 进行中的请求: 请求哈希 -> _InflightRequest
+_inflight: Dict[str, _InflightRequest] = {}
+
+def _discard_inflight(key: str, inflight: _InflightRequest, task: asyncio.Task):
+    """请求完成后从进行中的请求表移除"""
+    if _inflight.get(key) is inflight:
+        del _inflight[key]
+
+# 可重试的HTTP状态码（速率限制和服务端临时错误），其他错误立即失败
+RETRYABLE_STATUS_CODES = frozenset({429, 500, 502, 503, 504})
+MAX_RETRY_WAIT = 30
+
+def _retry_wait(attempt: int, retry_after: Optional[str] = None) -> float:
+    """
+    重试前的等待时间：优先使用Retry-After响应头，否则为带随机抖动的指数退避，避免多个代理同步重试
+
+    两种情况都不超过MAX_RETRY_WAIT秒
+    """
+    if retry_after:
+        try:
+            return min(max(0.0, float(retry_after)), MAX_RETRY_WAIT)
+        except ValueError:
+            pass
+    return min(2 ** attempt, MAX_RETRY_WAIT) * random.uniform(0.7, 1.3)
+
+@functools.lru_cache(maxsize=64)
+def _system_message(system_prompt: str, prompt_cache: bool = False) -> Dict:
+    """
+    系统消息字典（按内容缓存，系统提示词均为模块常量，各次调用共享同一对象，不可修改）
+
+    prompt_cache为True时添加cache_control标记，由服务端缓存该前缀
+    """
+    if prompt_cache:
+        return {
+            "role": "system",
+            "content": [{"type": "text", "text": system_prompt, "cache_control": {"type": "ephemeral"}}]
+        }
+    return {"role": "system", "content": system_prompt}
+
+@functools.lru_cache(maxsize=64)
+def _instructions_prefix(system_prompt: str) -> str:
+    """不支持系统提示词的模型：拼接在用户提示词前的系统提示词前缀（按内容缓存）"""
+    return f"Instructions: {system_prompt}\n\n"
+
+# 成本估算（每1M tokens的(输入, 输出)价格，美元），按OpenRouter模型路径索引
+COST_TABLE: Dict[str, Tuple[float, float]] = {
+    "anthropic/claude-3.5-sonnet": (3.0, 15.0),
+    "anthropic/claude-3-opus": (15.0, 75.0),
+    "openai/gpt-4-turbo": (10.0, 30.0),
+    "openai/gpt-4o": (5.0, 15.0),
+    "google/gemini-pro": (0.5, 1.5),
+    "deepseek/deepseek-chat": (0.14, 0.28),
+    "qwen/qwen-2.5-72b-instruct": (0.9, 0.9)
+}
+
+# 不带提供商前缀的模型名（如"gpt-4o"）到价格的映射
+_COST_BY_SHORT_NAME = {model.split("/", 1)[1]: rates for model, rates in COST_TABLE.items()}
+
+@functools.lru_cache(maxsize=128)
+def _cost_per_million_tokens(model: str) -> Optional[Tuple[float, float]]:
+    """查找模型价格，支持完整路径和不带提供商前缀的模型名；未知模型返回None"""
+    rates = COST_TABLE.get(model)
+    if rates is None:
+        rates = _COST_BY_SHORT_NAME.get(model.split("/", 1)[-1])
+    return rates
+
+# 错误日志中记录的响应内容最大长度（字符）
+MAX_LOGGED_RESPONSE_CHARS = 500
+
 @dataclass
 class ModelConfig:
     """模型配置"""
@@ -20,6 +140,8 @@ class ModelConfig:
     top_p: float = 1.0
     supports_system: bool = True
     supports_thinking: bool = False
+    # 是否支持cache_control提示词缓存标记（Anthropic、Gemini），支持时系统提示词前缀由服务端缓存复用
+    supports_prompt_cache: bool = False
 
 # 支持的模型配置
 MODEL_CONFIGS = {
@@ -27,7 +149,8 @@ MODEL_CONFIGS = {
         provider="google",
         max_tokens=8192,
         temperature=0.1,
-        supports_thinking=False
+        supports_thinking=False,
+        supports_prompt_cache=True
     ),
     "openai/gpt-oss-20b:free": ModelConfig(
         provider="openai",
@@ -40,15 +163,19 @@ MODEL_CONFIGS = {
 class OpenRouterAdapter:
     """OpenRouter API适配器"""
     
-    def __init__(self, api_key: str, model: str = "openai/gpt-3.5-turbo"):
+    def __init__(self, api_key: str, model: str = "openai/gpt-3.5-turbo",
+                 client: Optional[httpx.AsyncClient] = None):
         self.api_url = "https://openrouter.ai/api/v1/chat/completions"
         self.api_key = api_key
         self.model = model
+        # 可注入的异步HTTP客户端（由调用方负责关闭），未指定时使用共享客户端
+        self.client = client
         # 使用默认配置如果模型不在预定义列表中
         self.config = MODEL_CONFIGS.get(model, ModelConfig(
             provider="openai",
             max_tokens=4096,
-            temperature=0.1
+            temperature=0.1,
+            supports_prompt_cache=any(name in model.lower() for name in ("claude", "gemini"))
         ))
         self.headers = {
             "Authorization": f"Bearer {api_key}",
@@ -66,13 +193,10 @@ class OpenRouterAdapter:
         
         # 添加系统提示词
         if system_prompt and self.config.supports_system:
-            messages.append({
-                "role": "system",
-                "content": system_prompt
-            })
+            messages.append(_system_message(system_prompt, self.config.supports_prompt_cache))
         elif system_prompt:
             # 如果模型不支持系统提示词，将其添加到第一个用户消息中
-            user_prompt = f"Instructions: {system_prompt}\n\n{user_prompt}"
+            user_prompt = _instructions_prefix(system_prompt) + user_prompt
         
         # 添加对话历史
         if conversation_history:
@@ -86,24 +210,12 @@ class OpenRouterAdapter:
         
         return messages
     
-    def call_api(self, system_prompt: str, user_prompt: str, 
-                 conversation_history: List[Dict] = None,
-                 temperature: float = None,
-                 max_tokens: int = None,
-                 retry_count: int = 3) -> Dict:
+    def build_request_body(self, system_prompt: str, user_prompt: str,
+                           conversation_history: List[Dict] = None,
+                           temperature: float = None,
+                           max_tokens: int = None) -> Dict:
         """
-        调用OpenRouter API
-        
-        Args:
-            system_prompt: 系统提示词
-            user_prompt: 用户提示词
-            conversation_history: 对话历史
-            temperature: 温度参数
-            max_tokens: 最大token数
-            retry_count: 重试次数
-        
-        Returns:
-            API响应
+        构建OpenRouter请求体
         """
         messages = self.build_messages(system_prompt, user_prompt, conversation_history)
         
@@ -119,7 +231,7 @@ class OpenRouterAdapter:
         # Gemini 2.5 Pro 特殊配置
         if "gemini-2.5-pro" in self.model:
             # 使用更高的max_tokens避免内容被截断
-            request_body["max_tokens"] = 8192
+            request_body["max_tokens"] = max(request_body["max_tokens"], 8192)
             # 添加provider参数
             request_body["provider"] = {
                 "order": ["Google"],
@@ -134,71 +246,224 @@ class OpenRouterAdapter:
                 }
             }
         
-        # 重试逻辑
+        return request_body
+    
+    def call_api(self, system_prompt: str, user_prompt: str, 
+                 conversation_history: List[Dict] = None,
+                 temperature: float = None,
+                 max_tokens: int = None,
+                 retry_count: int = 3) -> Dict:
+        """
+        调用OpenRouter API
+        
+        Args:
+            system_prompt: 系统提示词
+            user_prompt: 用户提示词
+            conversation_history: 对话历史
+            temperature: 温度参数
+            max_tokens: 最大token数
+            retry_count: 重试次数
+        
+        Returns:
+            API响应
+        """
+        request_body = self.build_request_body(
+            system_prompt, user_prompt, conversation_history, temperature, max_tokens
+        )
+        # 请求体只序列化一次，各次重试复用
+        content = orjson.dumps(request_body)
+        
+        # 重试逻辑：仅重试网络错误、超时、429和5xx
         for attempt in range(retry_count):
+            last_attempt = attempt == retry_count - 1
             try:
                 logger.info(f"Calling OpenRouter API with model {self.model} (attempt {attempt + 1})")
                 
-                response = requests.post(
+                response = get_shared_session().post(
                     self.api_url,
                     headers=self.headers,
-                    json=request_body,
+                    data=content,
                     timeout=120  # 2分钟超时
                 )
-                
-                if response.status_code == 200:
-                    return response.json()
-                elif response.status_code == 429:
-                    # 速率限制，等待后重试
-                    wait_time = min(2 ** attempt, 30)
-                    logger.warning(f"Rate limited, waiting {wait_time} seconds...")
-                    time.sleep(wait_time)
-                else:
-                    logger.error(f"API error: {response.status_code} - {response.text}")
-                    if attempt == retry_count - 1:
-                        raise Exception(f"API call failed: {response.text}")
-            
-            except requests.exceptions.Timeout:
-                logger.error(f"Request timeout (attempt {attempt + 1})")
-                if attempt == retry_count - 1:
-                    raise
-            except Exception as e:
-                logger.error(f"Error calling API: {e}")
-                if attempt == retry_count - 1:
+            except (requests.ConnectionError, requests.Timeout) as e:
+                logger.error(f"Request failed (attempt {attempt + 1}): {e}")
+                if last_attempt:
                     raise
+                time.sleep(_retry_wait(attempt))
+                continue
+            
+            if response.status_code == 200:
+                return orjson.loads(response.content)
+            
+            logger.error(f"API error: {response.status_code} - {response.text}")
+            if response.status_code not in RETRYABLE_STATUS_CODES or last_attempt:
+                raise Exception(f"API call failed: {response.text}")
+            
+            wait_time = _retry_wait(attempt, response.headers.get("Retry-After"))
+            logger.warning(f"Retrying in {wait_time:.1f} seconds...")
+            time.sleep(wait_time)
         
         raise Exception("Max retry attempts reached")
-    
+
+    async def acall_api(self, system_prompt: str, user_prompt: str,
+                        conversation_history: List[Dict] = None,
+                        temperature: float = None,
+                        max_tokens: int = None,
+                        retry_count: int = 3,
+                        semaphore: Optional[asyncio.Semaphore] = None,
+                        stream: bool = False) -> Dict:
+        """
+        异步调用OpenRouter API（不阻塞事件循环）
+
+        参数与call_api相同，semaphore用于限制同时进行的HTTP请求数量；
+        stream为True时以SSE流式接收，取消调用会立即关闭连接并停止服务端生成
+        """
+        request_body = self.build_request_body(
+            system_prompt, user_prompt, conversation_history, temperature, max_tokens
+        )
+        if stream:
+            request_body["stream"] = True
+        
+        # 合并进行中的相同请求（如多个代理验证同一解答）：后来者等待第一个请求的结果；
+        # 代理的生成调用带有各自的温度，不会被合并
+        key = hashlib.blake2b(
+            self.api_key.encode("utf-8") + orjson.dumps(request_body, option=orjson.OPT_SORT_KEYS),
+            digest_size=16
+        ).hexdigest()
+        inflight = _inflight.get(key)
+        if inflight is None:
+            inflight = _InflightRequest(asyncio.create_task(
+                self._send_request(request_body, retry_count, semaphore)
+            ))
+            _inflight[key] = inflight
+            inflight.task.add_done_callback(functools.partial(_discard_inflight, key, inflight))
+        
+        inflight.waiters += 1
+        try:
+            response = await asyncio.shield(inflight.task)
+        finally:
+            inflight.waiters -= 1
+            # 所有等待者都已取消时，取消底层请求；同时立即移出进行中的请求表，
+            # 之后到达的相同请求重新发送，而不是等待正在取消的请求
+            if inflight.waiters == 0 and not inflight.task.done():
+                _discard_inflight(key, inflight, inflight.task)
+                inflight.task.cancel()
+        
+        return response
+
+    async def _send_request(self, request_body: Dict, retry_count: int,
+                            semaphore: Optional[asyncio.Semaphore]) -> Dict:
+        """发送请求（含重试逻辑）"""
+        client = self.client if self.client is not None else get_shared_client()
+        # 请求体只序列化一次，各次重试复用
+        content = orjson.dumps(request_body)
+
+        # 重试逻辑：仅重试网络错误、超时、429和5xx
+        for attempt in range(retry_count):
+            last_attempt = attempt == retry_count - 1
+            try:
+                logger.info(f"Calling OpenRouter API with model {self.model} (attempt {attempt + 1})")
+
+                if semaphore is None:
+                    status_code, payload, retry_after = await self._post(client, request_body, content)
+                else:
+                    async with semaphore:
+                        status_code, payload, retry_after = await self._post(client, request_body, content)
+            except httpx.TransportError as e:
+                logger.error(f"Request failed (attempt {attempt + 1}): {e!r}")
+                if last_attempt:
+                    raise
+                await asyncio.sleep(_retry_wait(attempt))
+                continue
+
+            if status_code == 200:
+                return payload
+
+            logger.error(f"API error: {status_code} - {payload}")
+            if status_code not in RETRYABLE_STATUS_CODES or last_attempt:
+                raise Exception(f"API call failed: {payload}")
+
+            wait_time = _retry_wait(attempt, retry_after)
+            logger.warning(f"Retrying in {wait_time:.1f} seconds...")
+            await asyncio.sleep(wait_time)
+
+        raise Exception("Max retry attempts reached")
+
+    async def _post(self, client: httpx.AsyncClient, request_body: Dict,
+                    content: bytes) -> Tuple[int, Any, Optional[str]]:
+        """
+        发送一次请求，返回(状态码, 响应, Retry-After)；成功时响应为解析后的JSON，否则为错误文本
+
+        流式请求的增量内容会被拼接为与非流式请求相同格式的响应
+        """
+        if not request_body.get("stream"):
+            response = await client.post(self.api_url, headers=self.headers, content=content)
+            if response.status_code == 200:
+                return 200, orjson.loads(response.content), None
+            return response.status_code, response.text, response.headers.get("Retry-After")
+
+        async with client.stream("POST", self.api_url, headers=self.headers, content=content) as response:
+            if response.status_code != 200:
+                await response.aread()
+                return response.status_code, response.text, response.headers.get("Retry-After")
+            content = []
+            reasoning = []
+            async for delta in self._iter_sse_deltas(response):
+                if delta.get("content"):
+                    content.append(delta["content"])
+                if delta.get("reasoning"):
+                    reasoning.append(delta["reasoning"])
+
+        message = {"role": "assistant", "content": "".join(content)}
+        if reasoning:
+            message["reasoning"] = "".join(reasoning)
+        return 200, {"choices": [{"message": message}]}, None
+
+    @staticmethod
+    async def _iter_sse_deltas(response: httpx.Response) -> AsyncIterator[Dict]:
+        """逐个产出SSE流中的delta"""
+        async for line in response.aiter_lines():
+            # 跳过空行和注释行（如": OPENROUTER PROCESSING"）
+            if not line.startswith("data:"):
+                continue
+            data = line[5:].strip()
+            if data == "[DONE]":
+                break
+            chunk = orjson.loads(data)
+            if "error" in chunk:
+                raise Exception(f"API call failed: {chunk['error']}")
+            choices = chunk.get("choices")
+            if choices:
+                yield choices[0].get("delta") or {}
+
     def extract_response_text(self, response: Dict) -> str:
         """
         从API响应中提取文本
         """
         try:
             message = response['choices'][0]['message']
-            
-            # 处理Gemini 2.5 Pro的reasoning字段问题
-            # 如果content为空但有reasoning，使用第一个用户消息作为回退
-            content = message.get('content', '')
-            
-            if not content and 'reasoning' in message:
-                # Gemini 2.5 Pro有时会将内容放在reasoning中
-                logger.warning("Content is empty, checking reasoning field")
-                reasoning = message.get('reasoning', '')
-                if reasoning:
-                    logger.info(f"Using reasoning as fallback content (length: {len(reasoning)})")
-                    # 暂时返回一个默认响应，让系统继续运行
-                    return "I need to process this request. Let me think about it step by step."
-            
-            if not content:
-                logger.error(f"Empty content in response: {json.dumps(message, indent=2)}")
-                # 返回默认响应而不是抛出异常
-                return "I'm processing your request. Please wait."
-                
-            return content
-        except (KeyError, IndexError) as e:
+        except (KeyError, IndexError, TypeError) as e:
             logger.error(f"Error extracting response text: {e}")
-            logger.error(f"Full response: {json.dumps(response, indent=2)}")
+            logger.error("Full response: %s", repr(response)[:MAX_LOGGED_RESPONSE_CHARS])
             raise Exception("Failed to extract response text")
+        
+        content = message.get('content')
+        if content:
+            return content
+        
+        # 处理Gemini 2.5 Pro的reasoning字段问题
+        # 如果content为空但有reasoning，使用第一个用户消息作为回退
+        reasoning = message.get('reasoning')
+        if reasoning:
+            # Gemini 2.5 Pro有时会将内容放在reasoning中
+            logger.warning("Content is empty, checking reasoning field")
+            logger.info(f"Using reasoning as fallback content (length: {len(reasoning)})")
+            # 暂时返回一个默认响应，让系统继续运行
+            return "I need to process this request. Let me think about it step by step."
+        
+        logger.error("Empty content in response: %s", repr(message)[:MAX_LOGGED_RESPONSE_CHARS])
+        # 返回默认响应而不是抛出异常
+        return "I'm processing your request. Please wait."
     
     def convert_gemini_request(self, gemini_payload: Dict) -> tuple:
         """
@@ -249,21 +514,9 @@ class OpenRouterAdapter:
         估算API调用成本（美元）
         注意：这只是估算，实际成本可能有所不同
         """
-        # 成本估算（每1M tokens的价格，美元）
-        cost_table = {
-            "claude-3.5-sonnet": {"input": 3.0, "output": 15.0},
-            "claude-3-opus": {"input": 15.0, "output": 75.0},
-            "gpt-4-turbo": {"input": 10.0, "output": 30.0},
-            "gpt-4o": {"input": 5.0, "output": 15.0},
-            "gemini-pro": {"input": 0.5, "output": 1.5},
-            "deepseek-chat": {"input": 0.14, "output": 0.28},
-            "qwen-2.5-72b": {"input": 0.9, "output": 0.9}
-        }
-        
-        if self.model in cost_table:
-            costs = cost_table[self.model]
-            input_cost = (input_tokens / 1_000_000) * costs["input"]
-            output_cost = (output_tokens / 1_000_000) * costs["output"]
-            return input_cost + output_cost
+        rates = _cost_per_million_tokens(self.model)
+        if rates is not None:
+            input_rate, output_rate = rates
+            return (input_tokens / 1_000_000) * input_rate + (output_tokens / 1_000_000) * output_rate
         
         return 0.0
\ No newline at end of file
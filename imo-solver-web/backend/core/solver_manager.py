@@ -2,19 +2,29 @@
 求解管理器，管理多个IMO代理的并行执行
 """
 import asyncio
-import json
+import functools
 import time
 import os
 from datetime import datetime
-from typing import Dict, List, Optional, Callable
+from typing import Dict, List, Optional, Callable, Union
 from dataclasses import dataclass, field
 import logging
+import aiofiles
+from collections import OrderedDict
 
 from .imo_agent import IMOAgent, AgentStatus
 from .openrouter_adapter import OpenRouterAdapter
+from .verification_batcher import VerificationBatcher
+from .state_store import create_state_store
 
 logger = logging.getLogger(__name__)
 
+# 内存中最多保留的任务数，超出时淘汰最早创建的未运行任务
+MAX_RETAINED_TASKS = 256
+
+# OpenRouter每分钟请求数限制，用于计算同时进行的API调用上限
+RATE_LIMIT_RPM = int(os.getenv("OPENROUTER_RATE_LIMIT_RPM", "600"))
+
 @dataclass
 class SolverTask:
     """求解任务"""
@@ -26,7 +36,11 @@ class SolverTask:
     other_prompts: List[str] = field(default_factory=list)
     timeout: Optional[int] = None
     max_iterations: int = 30
+    skip_self_improvement_if_correct: bool = True
     agents: Dict[int, IMOAgent] = field(default_factory=dict)
+    api_adapter: Optional[OpenRouterAdapter] = None
+    api_semaphore: Optional[asyncio.Semaphore] = None
+    verification_batcher: Optional[VerificationBatcher] = None
     start_time: float = 0
     end_time: float = 0
     solution_found: bool = False
@@ -37,10 +51,20 @@ class SolverManager:
     """求解管理器"""
     
     def __init__(self):
-        self.tasks: Dict[str, SolverTask] = {}
+        self.tasks: "OrderedDict[str, SolverTask]" = OrderedDict()
         self.running_tasks: set = set()
         self.completed_tasks: set = set()
         self.websocket_callbacks: Dict[str, Callable] = {}
+        # 任务状态快照，在任务和代理状态变化时更新，供任务列表直接返回
+        self._status_snapshot: Dict[str, Dict] = {}
+        # 可选的Redis状态存储（配置REDIS_URL时启用），供多worker共享任务状态
+        self.state_store = create_state_store()
+        # 每个任务待写入状态存储的最新状态（写入键 -> 写入函数）及其写任务；
+        # 同一任务的写入按顺序执行，避免旧状态晚于新状态写入
+        self._pending_writes: Dict[str, Dict] = {}
+        self._state_writers: Dict[str, asyncio.Task] = {}
+        # 运行中任务里处于RUNNING状态的代理数，随代理状态变化增减
+        self._running_agent_count = 0
     
     def register_websocket_callback(self, client_id: str, callback: Callable):
         """注册WebSocket回调函数"""
@@ -60,7 +84,8 @@ class SolverManager:
         api_key: str,
         other_prompts: List[str] = None,
         timeout: int = None,
-        max_iterations: int = 30
+        max_iterations: int = 30,
+        skip_self_improvement_if_correct: bool = True
     ) -> SolverTask:
         """创建新的求解任务"""
         task = SolverTask(
@@ -71,16 +96,22 @@ class SolverManager:
             api_key=api_key,
             other_prompts=other_prompts or [],
             timeout=timeout,
-            max_iterations=max_iterations
+            max_iterations=max_iterations,
+            skip_self_improvement_if_correct=skip_self_improvement_if_correct
         )
+        # 任务内所有代理共享同一个API适配器（相同的API密钥和模型）
+        task.api_adapter = OpenRouterAdapter(api_key=api_key, model=model)
         
         self.tasks[task_id] = task
+        self.tasks.move_to_end(task_id)
+        self._evict_tasks()
+        self._on_task_state_change(task_id)
         logger.info(f"Created task {task_id} with {num_agents} agents using model {model}")
         
         return task
     
-    async def agent_websocket_callback(self, task_id: str, message: Dict):
-        """代理的WebSocket回调"""
+    async def agent_websocket_callback(self, task_id: str, message: Union[Dict, List[Dict]]):
+        """代理的WebSocket回调；message为列表时作为一组消息合并发送"""
         if task_id in self.websocket_callbacks:
             callback = self.websocket_callbacks[task_id]
             await callback(message)
@@ -93,17 +124,15 @@ class SolverManager:
     ) -> Optional[str]:
         """运行单个代理"""
         try:
-            # 创建API适配器
-            api_adapter = OpenRouterAdapter(
-                api_key=task.api_key,
-                model=task.model
-            )
-            
             # 创建代理
             agent = IMOAgent(
                 agent_id=agent_id,
-                api_adapter=api_adapter,
-                websocket_callback=websocket_callback
+                api_adapter=task.api_adapter,
+                websocket_callback=websocket_callback,
+                api_semaphore=task.api_semaphore,
+                status_listener=functools.partial(self._on_agent_status_change, task.task_id),
+                verification_batcher=task.verification_batcher,
+                skip_self_improvement_if_correct=task.skip_self_improvement_if_correct
             )
             
             task.agents[agent_id] = agent
@@ -166,6 +195,18 @@ class SolverManager:
         task.start_time = time.time()
         self.running_tasks.add(task_id)
         
+        # 所有代理共享一个信号量，避免超出OpenRouter速率限制
+        task.api_semaphore = asyncio.Semaphore(max(1, min(task.num_agents, RATE_LIMIT_RPM // 60)))
+        
+        # 多个代理时合并同一时间窗口内的验证请求
+        if task.num_agents > 1:
+            task.verification_batcher = VerificationBatcher(
+                task.api_adapter,
+                task.problem_statement,
+                api_semaphore=task.api_semaphore
+            )
+        
+        self._on_task_state_change(task_id)
         logger.info(f"Starting task {task_id} with {task.num_agents} agents")
         
         # 创建WebSocket回调
@@ -173,7 +214,7 @@ class SolverManager:
             await self.agent_websocket_callback(task_id, message)
         
         # 创建所有代理任务
-        agent_tasks = []
+        agent_tasks = {}
         for agent_id in range(task.num_agents):
             agent_task = asyncio.create_task(
                 self.run_single_agent(
@@ -182,19 +223,27 @@ class SolverManager:
                     websocket_callback=task_websocket_callback if task_id in self.websocket_callbacks else None
                 )
             )
-            agent_tasks.append((agent_id, agent_task))
+            agent_tasks[agent_task] = agent_id
         
         # 等待所有代理完成或找到解答
         completed_agents = []
         successful_agents = []
         failed_agents = []
+        pending = set(agent_tasks)
         
         try:
-            # 使用 as_completed 来处理先完成的任务
-            for agent_id, agent_task in agent_tasks:
-                try:
-                    solution = await agent_task
+            # 按完成顺序处理代理结果，找到解答后立即取消其余代理
+            while pending and not task.solution_found:
+                done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                for agent_task in done:
+                    agent_id = agent_tasks[agent_task]
                     completed_agents.append(agent_id)
+                    try:
+                        solution = agent_task.result()
+                    except Exception as e:
+                        logger.error(f"Agent {agent_id} failed: {e}")
+                        failed_agents.append(agent_id)
+                        continue
                     
                     if solution:
                         successful_agents.append(agent_id)
@@ -202,34 +251,44 @@ class SolverManager:
                             task.solution_found = True
                             task.solution_agent_id = agent_id
                             task.solution = solution
+                            self._on_task_state_change(task_id)
                             
-                            # 保存解决方案到文件
+                            # 保存解决方案到文件（解答内容已由代理分片推送给客户端）
                             await self.save_solution_to_file(task_id, agent_id, solution)
-                            
-                            # 通知找到解答
-                            if task_id in self.websocket_callbacks:
-                                await self.agent_websocket_callback(task_id, {
-                                    "type": "solution_found",
-                                    "agent_id": agent_id,
-                                    "solution": solution
-                                })
                     else:
                         failed_agents.append(agent_id)
-                        
-                except Exception as e:
-                    logger.error(f"Agent {agent_id} failed: {e}")
-                    failed_agents.append(agent_id)
-                    completed_agents.append(agent_id)
         
         finally:
-            # 确保所有任务都被取消（如果还在运行）
-            for agent_id, agent_task in agent_tasks:
-                if not agent_task.done():
-                    agent_task.cancel()
+            if task.verification_batcher is not None:
+                task.verification_batcher.close()
+            # 取消仍在运行的代理（包括其进行中的API请求），并等待其清理完成
+            for agent_task in pending:
+                agent_task.cancel()
+            if pending:
+                await asyncio.gather(*pending, return_exceptions=True)
+                cancelled = []
+                for agent_task in pending:
+                    agent = task.agents.get(agent_tasks[agent_task])
+                    if agent and agent.state.status not in (AgentStatus.SUCCESS, AgentStatus.FAILED):
+                        await agent.update_status(AgentStatus.FAILED, "已取消", notify=False)
+                        cancelled.append(agent)
+                # 被取消代理的状态更新合并为一组发送
+                if cancelled and task_id in self.websocket_callbacks:
+                    await self.agent_websocket_callback(task_id, [agent.status_message() for agent in cancelled])
         
         task.end_time = time.time()
         self.running_tasks.discard(task_id)
+        self._running_agent_count -= sum(
+            1 for agent in task.agents.values() if agent.state.status == AgentStatus.RUNNING
+        )
         self.completed_tasks.add(task_id)
+        self._on_task_state_change(task_id)
+        
+        # 任务结束后释放代理的对话历史等，仅保留状态摘要
+        task.verification_batcher = None
+        task.api_semaphore = None
+        for agent in task.agents.values():
+            agent.release()
         
         # 计算统计信息
         stats = {
@@ -251,7 +310,7 @@ class SolverManager:
                 "stats": stats
             })
         
-        logger.info(f"Task {task_id} completed. Stats: {json.dumps(stats)}")
+        logger.info("Task %s completed. Stats: %s", task_id, stats)
         
         return stats
     
@@ -286,16 +345,94 @@ class SolverManager:
             "elapsed_time": time.time() - task.start_time if task.start_time > 0 else 0
         }
     
+    def _refresh_status_snapshot(self, task_id: str):
+        """重新计算任务的状态快照"""
+        status = self.get_task_status(task_id)
+        if status is None:
+            self._status_snapshot.pop(task_id, None)
+        else:
+            self._status_snapshot[task_id] = status
+    
+    def _on_task_state_change(self, task_id: str):
+        """任务状态变化时更新快照，并写入状态存储"""
+        self._refresh_status_snapshot(task_id)
+        
+        task = self.tasks.get(task_id)
+        if self.state_store and task:
+            self._queue_state_write(task_id, "task", functools.partial(
+                self.state_store.save_task,
+                task_id,
+                status=self._status_snapshot[task_id]["status"],
+                num_agents=task.num_agents,
+                model=task.model,
+                solution_found=task.solution_found,
+                solution_agent_id=task.solution_agent_id,
+                start_time=task.start_time
+            ))
+    
+    def _on_agent_status_change(self, task_id: str, agent: IMOAgent, old_status: AgentStatus, new_status: AgentStatus):
+        """代理状态变化时更新任务状态快照，并写入状态存储"""
+        self._refresh_status_snapshot(task_id)
+        
+        if task_id in self.running_tasks and old_status != new_status:
+            if new_status == AgentStatus.RUNNING:
+                self._running_agent_count += 1
+            elif old_status == AgentStatus.RUNNING:
+                self._running_agent_count -= 1
+        
+        if self.state_store:
+            self._queue_state_write(task_id, agent.agent_id, functools.partial(
+                self.state_store.save_agent_state,
+                task_id,
+                agent.agent_id,
+                status=new_status.value,
+                current_step=agent.state.current_step,
+                iteration=agent.state.iteration,
+                correct_count=agent.state.correct_count,
+                error_count=agent.state.error_count
+            ))
+    
+    def _queue_state_write(self, task_id: str, key, write: Callable, replace_pending: bool = False):
+        """
+        将状态存储写入加入任务的写入队列，由该任务唯一的写任务按顺序执行
+        
+        同一写入键尚未执行的旧状态直接被最新状态覆盖；replace_pending为True时丢弃所有未执行的写入（如删除任务）
+        """
+        if replace_pending:
+            self._pending_writes[task_id] = {}
+        self._pending_writes.setdefault(task_id, {})[key] = write
+        if task_id not in self._state_writers:
+            self._state_writers[task_id] = asyncio.create_task(self._drain_state_writes(task_id))
+    
+    async def _drain_state_writes(self, task_id: str):
+        """依次执行任务的待写入状态，直到队列为空"""
+        try:
+            while True:
+                pending = self._pending_writes.get(task_id)
+                if not pending:
+                    break
+                key = next(iter(pending))
+                write = pending.pop(key)
+                try:
+                    await write()
+                except Exception as e:
+                    logger.error(f"State store write failed for task {task_id}: {e}")
+        finally:
+            self._pending_writes.pop(task_id, None)
+            self._state_writers.pop(task_id, None)
+    
+    def get_all_task_status(self) -> List[Dict]:
+        """获取所有任务的状态（基于快照，仅刷新运行中任务的耗时）"""
+        now = time.time()
+        for task_id in self.running_tasks:
+            status = self._status_snapshot.get(task_id)
+            if status and status["start_time"] > 0:
+                status["elapsed_time"] = now - status["start_time"]
+        return list(self._status_snapshot.values())
+    
     def get_running_agents_count(self) -> int:
         """获取正在运行的代理数量"""
-        count = 0
-        for task_id in self.running_tasks:
-            if task_id in self.tasks:
-                task = self.tasks[task_id]
-                for agent in task.agents.values():
-                    if agent.state.status == AgentStatus.RUNNING:
-                        count += 1
-        return count
+        return self._running_agent_count
     
     def get_completed_tasks_count(self) -> int:
         """获取已完成的任务数量"""
@@ -306,42 +443,54 @@ class SolverManager:
         try:
             # 创建solutions目录（如果不存在）
             solutions_dir = "solutions"
-            os.makedirs(solutions_dir, exist_ok=True)
+            await asyncio.to_thread(os.makedirs, solutions_dir, exist_ok=True)
             
             # 生成文件名：task_id_agent_id_timestamp.txt
-            timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
+            now = datetime.now()
+            timestamp = now.strftime("%Y%m%d_%H%M%S")
             filename = f"{solutions_dir}/solution_{task_id[:8]}_agent{agent_id}_{timestamp}.txt"
+            header = f"Task ID: {task_id}\nAgent ID: {agent_id}\nTimestamp: {now.isoformat()}\n"
+            separator = "=" * 60 + "\n\n"
             
             # 保存解决方案
-            with open(filename, 'w', encoding='utf-8') as f:
-                f.write(f"Task ID: {task_id}\n")
-                f.write(f"Agent ID: {agent_id}\n")
-                f.write(f"Timestamp: {datetime.now().isoformat()}\n")
-                f.write("="*60 + "\n\n")
-                f.write(solution)
+            async with aiofiles.open(filename, 'w', encoding='utf-8') as f:
+                await f.write(header + separator + solution)
             
             logger.info(f"Solution saved to {filename}")
             
             # 同时保存一个latest.txt文件，方便查看最新的解答
             latest_filename = f"{solutions_dir}/latest_solution.txt"
-            with open(latest_filename, 'w', encoding='utf-8') as f:
-                f.write(f"Task ID: {task_id}\n")
-                f.write(f"Agent ID: {agent_id}\n")
-                f.write(f"Timestamp: {datetime.now().isoformat()}\n")
-                f.write(f"File: {filename}\n")
-                f.write("="*60 + "\n\n")
-                f.write(solution)
+            async with aiofiles.open(latest_filename, 'w', encoding='utf-8') as f:
+                await f.write(f"{header}File: {filename}\n{separator}{solution}")
             
             logger.info(f"Latest solution saved to {latest_filename}")
             
         except Exception as e:
             logger.error(f"Failed to save solution to file: {e}")
     
+    def _evict_tasks(self):
+        """任务数超过MAX_RETAINED_TASKS时，从内存中淘汰最早的未运行任务（Redis中的状态由TTL过期）"""
+        excess = len(self.tasks) - MAX_RETAINED_TASKS
+        if excess <= 0:
+            return
+        evicted = [task_id for task_id in self.tasks if task_id not in self.running_tasks][:excess]
+        for task_id in evicted:
+            del self.tasks[task_id]
+            self.completed_tasks.discard(task_id)
+            self._status_snapshot.pop(task_id, None)
+            self.websocket_callbacks.pop(task_id, None)
+        if evicted:
+            logger.info(f"Evicted {len(evicted)} old tasks from memory")
+    
     def cleanup_task(self, task_id: str):
         """清理任务数据"""
         if task_id in self.tasks:
             del self.tasks[task_id]
         self.running_tasks.discard(task_id)
         self.completed_tasks.discard(task_id)
+        self._status_snapshot.pop(task_id, None)
+        if self.state_store:
+            self._queue_state_write(task_id, "delete", functools.partial(self.state_store.delete_task, task_id),
+                                    replace_pending=True)
         if task_id in self.websocket_callbacks:
             del self.websocket_callbacks[task_id]
\ No newline at end of file
@@ -0,0 +1,140 @@
+"""
+任务状态存储（Redis）
+多worker部署时，各worker将任务和代理状态写入Redis，状态查询可由任意worker响应
+"""
+import os
+import time
+import logging
+from typing import Dict, List, Optional
+
+import orjson
+import redis.asyncio as aioredis
+
+logger = logging.getLogger(__name__)
+
+# 设置REDIS_URL后启用，例如 redis://localhost:6379/0
+REDIS_URL = os.getenv("REDIS_URL")
+
+# 任务状态在Redis中的保留时间（秒）
+STATE_TTL = 24 * 3600
+
+TASKS_KEY = "tasks"
+
+class TaskStateStore:
+    """
+    基于Redis哈希的任务状态存储
+    
+    任务元数据存放在 task:{id} 哈希中；各代理状态存放在 task:{id}:agent_states 哈希中，
+    字段为代理ID，值为JSON，读取一个任务只需两条HGETALL
+    """
+
+    def __init__(self, url: str):
+        self.redis = aioredis.from_url(url, decode_responses=True)
+
+    @staticmethod
+    def _task_key(task_id: str) -> str:
+        return f"task:{task_id}"
+
+    @staticmethod
+    def _agents_key(task_id: str) -> str:
+        return f"task:{task_id}:agent_states"
+
+    async def save_task(self, task_id: str, status: str, num_agents: int, model: str,
+                        solution_found: bool, solution_agent_id: Optional[int], start_time: float):
+        """写入任务级状态"""
+        key = self._task_key(task_id)
+        async with self.redis.pipeline(transaction=False) as pipe:
+            pipe.hset(key, mapping={
+                "status": status,
+                "num_agents": num_agents,
+                "model": model,
+                "solution_found": int(solution_found),
+                "solution_agent_id": "" if solution_agent_id is None else solution_agent_id,
+                "start_time": start_time
+            })
+            pipe.expire(key, STATE_TTL)
+            pipe.sadd(TASKS_KEY, task_id)
+            await pipe.execute()
+
+    async def save_agent_state(self, task_id: str, agent_id: int, status: str, current_step: str,
+                               iteration: int, correct_count: int, error_count: int):
+        """写入代理状态"""
+        key = self._agents_key(task_id)
+        async with self.redis.pipeline(transaction=False) as pipe:
+            pipe.hset(key, agent_id, orjson.dumps({
+                "status": status,
+                "current_step": current_step,
+                "iteration": iteration,
+                "correct_count": correct_count,
+                "error_count": error_count
+            }))
+            pipe.expire(key, STATE_TTL)
+            await pipe.execute()
+
+    @staticmethod
+    def _build_status(task_id: str, task: Dict, agents: Dict) -> Dict:
+        """由两个哈希的内容构建任务状态，格式与SolverManager.get_task_status一致"""
+        agents_status = [
+            {"agent_id": int(agent_id), **orjson.loads(agents[agent_id])}
+            for agent_id in sorted(agents, key=int)
+        ]
+
+        start_time = float(task["start_time"])
+        return {
+            "task_id": task_id,
+            "status": task["status"],
+            "num_agents": int(task["num_agents"]),
+            "model": task["model"],
+            "solution_found": task["solution_found"] == "1",
+            "solution_agent_id": int(task["solution_agent_id"]) if task["solution_agent_id"] else None,
+            "agents": agents_status,
+            "start_time": start_time,
+            "elapsed_time": time.time() - start_time if start_time > 0 else 0
+        }
+
+    async def get_task_status(self, task_id: str) -> Optional[Dict]:
+        """读取任务状态（一次往返）"""
+        async with self.redis.pipeline(transaction=False) as pipe:
+            pipe.hgetall(self._task_key(task_id))
+            pipe.hgetall(self._agents_key(task_id))
+            task, agents = await pipe.execute()
+        if not task:
+            return None
+        return self._build_status(task_id, task, agents)
+
+    async def list_task_status(self) -> List[Dict]:
+        """读取所有任务状态：先取任务ID集合，再用一个pipeline读取所有任务（共两次往返）"""
+        task_ids = list(await self.redis.smembers(TASKS_KEY))
+        if not task_ids:
+            return []
+        async with self.redis.pipeline(transaction=False) as pipe:
+            for task_id in task_ids:
+                pipe.hgetall(self._task_key(task_id))
+                pipe.hgetall(self._agents_key(task_id))
+            results = await pipe.execute()
+
+        tasks = []
+        expired = []
+        for i, task_id in enumerate(task_ids):
+            task, agents = results[2 * i], results[2 * i + 1]
+            if task:
+                tasks.append(self._build_status(task_id, task, agents))
+            else:
+                expired.append(task_id)
+        if expired:
+            await self.redis.srem(TASKS_KEY, *expired)
+        return tasks
+
+    async def delete_task(self, task_id: str):
+        """删除任务状态"""
+        async with self.redis.pipeline(transaction=False) as pipe:
+            pipe.delete(self._task_key(task_id), self._agents_key(task_id))
+            pipe.srem(TASKS_KEY, task_id)
+            await pipe.execute()
+
+def create_state_store() -> Optional[TaskStateStore]:
+    """如果配置了REDIS_URL则创建状态存储，否则返回None（仅使用进程内状态）"""
+    if not REDIS_URL:
+        return None
+    logger.info("Persisting task state to Redis")
+    return TaskStateStore(REDIS_URL)
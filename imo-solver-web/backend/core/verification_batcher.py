@@ -0,0 +1,147 @@
+"""
+验证请求合并
+将同一任务内多个代理在短时间窗口内提交的验证请求合并为一次API调用
+"""
+import asyncio
+import logging
+import re
+from typing import Dict, List, Optional, Tuple
+
+from .openrouter_adapter import OpenRouterAdapter
+from .prompts import BATCH_VERIFICATION_SYSTEM_PROMPT, VERIFICATION_REMINDER
+
+logger = logging.getLogger(__name__)
+
+# 收集验证请求的时间窗口（秒）和单批最多合并的解答数
+BATCH_WINDOW = 0.2
+BATCH_MAX_SIZE = 4
+
+# 合并验证结果中每个解答一节：以"=== Solution k ==="开头，以"VERDICT: yes/no"结尾
+# （使用纯文本而不是JSON，验证日志中未转义的LaTeX反斜杠不影响解析）
+_SECTION_RE = re.compile(r'^=== Solution (\d+) ===[ \t]*$', re.MULTILINE)
+_VERDICT_MARKER = "VERDICT:"
+_YES_RE = re.compile(r'^\W*yes\b', re.IGNORECASE)
+
+class VerificationBatcher:
+    """验证请求合并器，每个求解任务一个"""
+
+    def __init__(self, api_adapter: OpenRouterAdapter, problem_statement: str,
+                 api_semaphore: Optional[asyncio.Semaphore] = None,
+                 window: float = BATCH_WINDOW, max_batch_size: int = BATCH_MAX_SIZE):
+        self.api = api_adapter
+        self.problem_statement = problem_statement
+        self.api_semaphore = api_semaphore
+        self.window = window
+        self.max_batch_size = max_batch_size
+        # 等待合并的(详细解答, Future)
+        self._pending: List[Tuple[str, asyncio.Future]] = []
+        self._timer: Optional[asyncio.Task] = None
+        self._batches: set = set()
+
+    async def verify(self, detailed_solution: str) -> Optional[Tuple[str, str]]:
+        """
+        提交一个待验证的详细解答
+
+        Returns:
+            (错误报告, "yes"/"no")；窗口内只有这一个请求或合并验证失败时返回None，
+            调用方应改用单独验证
+        """
+        future = asyncio.get_running_loop().create_future()
+        self._pending.append((detailed_solution, future))
+        if len(self._pending) >= self.max_batch_size:
+            self._flush()
+        elif self._timer is None:
+            self._timer = asyncio.create_task(self._flush_after_window())
+        return await future
+
+    async def _flush_after_window(self):
+        """等待时间窗口结束后发送已收集的请求"""
+        await asyncio.sleep(self.window)
+        self._timer = None
+        self._flush()
+
+    def _flush(self):
+        """取出已收集的请求；多于一个时合并为一次API调用"""
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        # 跳过等待期间已取消的请求
+        items = [(solution, future) for solution, future in self._pending if not future.done()]
+        self._pending = []
+        if len(items) == 1:
+            items[0][1].set_result(None)
+        elif items:
+            batch = asyncio.create_task(self._verify_batch(items))
+            self._batches.add(batch)
+            batch.add_done_callback(self._batches.discard)
+
+    def build_prompt(self, solutions: List[str]) -> str:
+        """构建合并验证的用户提示词"""
+        parts = [f"""
+======================================================================
+### Problem ###
+
+{self.problem_statement}
+"""]
+        for i, solution in enumerate(solutions, 1):
+            parts.append(f"""
+======================================================================
+### Solution {i} ###
+
+{solution}
+""")
+        parts.append(VERIFICATION_REMINDER)
+        return "".join(parts)
+
+    @staticmethod
+    def parse_verdicts(text: str) -> Dict[int, Tuple[str, str]]:
+        """解析合并验证的分节结果: 解答编号 -> (错误报告, "yes"/"no")；缺少VERDICT行的解答不返回结果"""
+        parts = _SECTION_RE.split(text)
+        verdicts = {}
+        # split结果为[前导文本, 编号1, 内容1, 编号2, 内容2, ...]
+        for solution_id, section in zip(parts[1::2], parts[2::2]):
+            verdict_idx = section.rfind(_VERDICT_MARKER)
+            if verdict_idx == -1:
+                continue
+            verdict = section[verdict_idx + len(_VERDICT_MARKER):]
+            check_result = "yes" if _YES_RE.match(verdict) else "no"
+            bug_report = "" if check_result == "yes" else section[:verdict_idx].strip()
+            verdicts[int(solution_id)] = (bug_report, check_result)
+        return verdicts
+
+    async def _verify_batch(self, items: List[Tuple[str, asyncio.Future]]):
+        """合并验证一批解答，并将结果分发给各个等待者"""
+        verdicts = {}
+        try:
+            logger.info(f"Verifying {len(items)} solutions in one request")
+            response = await self.api.acall_api(
+                system_prompt=BATCH_VERIFICATION_SYSTEM_PROMPT,
+                user_prompt=self.build_prompt([solution for solution, _ in items]),
+                # 每个解答的验证日志各占一份输出预算，避免合并结果被截断
+                max_tokens=self.api.config.max_tokens * len(items),
+                semaphore=self.api_semaphore
+            )
+            verdicts = self.parse_verdicts(self.api.extract_response_text(response))
+            if len(verdicts) < len(items):
+                logger.warning(f"Batch verification returned {len(verdicts)} of {len(items)} verdicts")
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            logger.error(f"Batch verification failed: {e}")
+        finally:
+            # 缺失的结果返回None，由代理单独验证
+            for i, (_, future) in enumerate(items, 1):
+                if not future.done():
+                    future.set_result(verdicts.get(i))
+
+    def close(self):
+        """取消等待中的请求和进行中的合并验证"""
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        for _, future in self._pending:
+            if not future.done():
+                future.cancel()
+        self._pending = []
+        for batch in list(self._batches):
+            batch.cancel()
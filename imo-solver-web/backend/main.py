@@ -4,38 +4,61 @@ FastAPI主应用文件
 from fastapi import FastAPI, WebSocket, WebSocketDisconnect
 from fastapi.middleware.cors import CORSMiddleware
 from fastapi.staticfiles import StaticFiles
+from fastapi.responses import ORJSONResponse
+from starlette.responses import Response
+from starlette.routing import Route
 from contextlib import asynccontextmanager
 import asyncio
 import logging
+import os
+import orjson
 from typing import Dict, List
+import msgspec
 import uvicorn
 
-from api.solver import router as solver_router
+try:
+    import uvloop
+except ImportError:  # Windows上不可用，使用默认事件循环
+    uvloop = None
+
+try:
+    import httptools
+except ImportError:
+    httptools = None
+
+from api.solver import router as solver_router, solver_manager
 from api.config import router as config_router
-from websocket.connection_manager import manager
-from core.solver_manager import SolverManager
+from websocket.connection_manager import manager, client_message_decoder, CLIENT_ID_PATTERN, PING_FRAME, PONG_FRAME
+from core.openrouter_adapter import close_shared_client
+from core.state_store import REDIS_URL
 
 # 配置日志
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
-# 全局求解器管理器
-solver_manager = SolverManager()
-
 @asynccontextmanager
 async def lifespan(app: FastAPI):
     # 启动时执行
     logger.info("Starting IMO Solver Web Service...")
+    logger.info(f"Event loop: {type(asyncio.get_running_loop()).__module__}")
+    # 多worker部署时经Redis在worker之间转发WebSocket消息
+    if REDIS_URL:
+        await manager.start_relay(REDIS_URL)
+    refresh_task = asyncio.create_task(_refresh_status_loop())
     yield
     # 关闭时执行
     logger.info("Shutting down IMO Solver Web Service...")
+    refresh_task.cancel()
+    await manager.stop_relay()
     await manager.disconnect_all()
+    await close_shared_client()
 
 # 创建FastAPI应用
 app = FastAPI(
     title="IMO Solver Web API",
     description="Web interface for IMO problem solving with visualization",
     version="1.0.0",
+    default_response_class=ORJSONResponse,
     lifespan=lifespan
 )
 
@@ -54,53 +77,112 @@ app.include_router(config_router, prefix="/api/config", tags=["config"])
 
 # WebSocket端点
 @app.websocket("/ws/{client_id}")
-async def websocket_endpoint(websocket: WebSocket, client_id: str):
-    """WebSocket连接端点，用于实时更新"""
-    await manager.connect(websocket, client_id)
+async def websocket_endpoint(websocket: WebSocket, client_id: str, fmt: str = "json"):
+    """WebSocket连接端点，用于实时更新；fmt指定消息编码格式（json或msgpack）"""
+    if not CLIENT_ID_PATTERN.fullmatch(client_id):
+        await websocket.close(code=1008)
+        return
+    if not await manager.connect(websocket, client_id, fmt):
+        return
     try:
         while True:
             # 保持连接活跃
-            data = await websocket.receive_text()
+            message = await websocket.receive()
+            if message["type"] == "websocket.disconnect":
+                raise WebSocketDisconnect(message.get("code", 1000))
+            
+            frame = message.get("bytes")
+            if frame is not None:
+                # 二进制协议：单字节ping，其他为MessagePack消息
+                if frame == PING_FRAME:
+                    await manager.send_personal_message(PONG_FRAME, client_id)
+                    continue
+                try:
+                    command = client_message_decoder.decode(frame)
+                except msgspec.DecodeError:
+                    logger.warning("Invalid binary message from %s", client_id)
+                    continue
+                if logger.isEnabledFor(logging.DEBUG):
+                    logger.debug("Received message from %s: %s", client_id, command.type)
+                continue
             
-            # 处理来自客户端的消息
+            # 文本协议（兼容现有前端）
+            data = message.get("text")
             if data == "ping":
                 await manager.send_personal_message("pong", client_id)
             else:
-                # 处理其他消息类型
-                logger.info(f"Received message from {client_id}: {data}")
+                # 处理其他消息类型（逐条消息的日志只在DEBUG级别输出）
+                if logger.isEnabledFor(logging.DEBUG):
+                    logger.debug("Received message from %s: %s", client_id, data)
                 
     except WebSocketDisconnect:
         manager.disconnect(client_id)
-        logger.info(f"Client {client_id} disconnected")
+        logger.info("Client %s disconnected", client_id)
     except Exception as e:
-        logger.error(f"WebSocket error for client {client_id}: {e}")
+        logger.error("WebSocket error for client %s: %s", client_id, e)
         manager.disconnect(client_id)
 
-# 健康检查端点
-@app.get("/health")
-async def health_check():
-    """健康检查端点"""
-    return {
+# 健康检查和状态端点返回预先编码的JSON，由后台任务定期刷新
+HEALTH_REFRESH_INTERVAL = 1.0
+STATUS_REFRESH_INTERVAL = 0.5
+
+def _encode_health() -> bytes:
+    return orjson.dumps({
         "status": "healthy",
         "service": "IMO Solver Web API",
-        "active_connections": len(manager.active_connections)
-    }
+        "active_connections": len(manager.client_ids)
+    })
 
-# 获取当前运行状态
-@app.get("/api/status")
-async def get_status():
-    """获取系统状态"""
-    return {
+def _encode_status() -> bytes:
+    return orjson.dumps({
         "running_agents": solver_manager.get_running_agents_count(),
         "completed_tasks": solver_manager.get_completed_tasks_count(),
-        "active_connections": len(manager.active_connections)
-    }
+        "active_connections": len(manager.client_ids)
+    })
+
+_health_bytes = _encode_health()
+_status_bytes = _encode_status()
+
+async def _refresh_status_loop():
+    """每STATUS_REFRESH_INTERVAL秒刷新状态，每HEALTH_REFRESH_INTERVAL秒刷新健康检查"""
+    global _health_bytes, _status_bytes
+    ticks_per_health = round(HEALTH_REFRESH_INTERVAL / STATUS_REFRESH_INTERVAL)
+    tick = 0
+    while True:
+        await asyncio.sleep(STATUS_REFRESH_INTERVAL)
+        tick += 1
+        _status_bytes = _encode_status()
+        if tick % ticks_per_health == 0:
+            _health_bytes = _encode_health()
+
+# 健康检查和状态端点注册为Starlette路由，跳过FastAPI的参数解析和响应序列化
+async def health_check(request):
+    """健康检查端点"""
+    return Response(_health_bytes, media_type="application/json")
+
+async def get_status(request):
+    """获取系统状态"""
+    return Response(_status_bytes, media_type="application/json")
+
+app.router.routes.append(Route("/health", health_check, methods=["GET"]))
+app.router.routes.append(Route("/api/status", get_status, methods=["GET"]))
+
+# DEV=1 时以开发模式运行（自动重载，单worker）
+DEV = os.getenv("DEV") == "1"
+
+# worker数，可通过WEB_CONCURRENCY覆盖。默认1个：多worker需要配置REDIS_URL，
+# 而且任务解答(get_task_solution)和删除任务(delete_task)仍只读写本进程内的状态
+DEFAULT_WORKERS = 1
 
 if __name__ == "__main__":
     uvicorn.run(
         "main:app",
         host="0.0.0.0",
         port=8000,
-        reload=True,
+        reload=DEV,
+        workers=int(os.getenv("WEB_CONCURRENCY", str(DEFAULT_WORKERS))),
+        loop="uvloop" if uvloop else "asyncio",
+        http="httptools" if httptools else "h11",
+        ws="websockets",
         log_level="info"
     )
\ No newline at end of file
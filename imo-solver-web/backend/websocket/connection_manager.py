@@ -1,79 +1,400 @@
 """
 WebSocket连接管理器
 """
-from typing import Dict, List
+import asyncio
+import enum
+import os
+import re
+from typing import Any, Callable, Dict, List, Optional, Union
 from fastapi import WebSocket
-import json
+from starlette.websockets import WebSocketState
+import msgspec
+import orjson
 import logging
+import redis.asyncio as aioredis
 
 logger = logging.getLogger(__name__)
 
+class MessageType(enum.IntEnum):
+    """MessagePack客户端数组形式消息的类型编号"""
+    AGENT_UPDATE = 1
+
+class AgentUpdate(msgspec.Struct, array_like=True, gc=False):
+    """
+    MessagePack客户端的代理状态更新，编码为数组而不是map：
+    [1 (MessageType.AGENT_UPDATE), agent_id, status, data]
+    
+    字段顺序即协议，只能在末尾追加字段；其他消息仍为map，客户端按首元素区分数组消息类型
+    """
+    type: int
+    agent_id: int
+    status: str
+    data: Dict[str, Any]
+
+_msgpack_encoder = msgspec.msgpack.Encoder()
+
+def _encode_msgpack(message: Dict) -> bytes:
+    """MessagePack编码；agent_update转为数组形式的AgentUpdate"""
+    if message.get("type") == "agent_update":
+        return _msgpack_encoder.encode(AgentUpdate(
+            MessageType.AGENT_UPDATE, message["agent_id"], message["status"], message["data"]
+        ))
+    return _msgpack_encoder.encode(message)
+
+# 支持的消息编码格式，客户端通过 /ws/{client_id}?fmt=json|msgpack 选择，默认json
+ENCODERS: Dict[str, Callable[[Any], bytes]] = {
+    "json": orjson.dumps,
+    "msgpack": _encode_msgpack
+}
+# 合并多条已编码消息为一个batch帧的编码器（msgspec.Raw可直接嵌入已编码的内容）
+BATCH_ENCODERS: Dict[str, Callable[[Any], bytes]] = {
+    "json": msgspec.json.Encoder().encode,
+    "msgpack": _msgpack_encoder.encode
+}
+DEFAULT_FORMAT = "json"
+
+# 客户端ID只允许这些字符，可直接拼接进JSON字符串而无需转义
+CLIENT_ID_PATTERN = re.compile(r"[A-Za-z0-9_.-]{1,128}")
+
+# 内容固定的帧预先编码：连接成功消息只有client_id可变，JSON客户端直接拼接前后缀
+_CONNECT_PREFIX = b'{"type":"connection","status":"connected","client_id":"'
+_CONNECT_SUFFIX = b'"}'
+SHUTDOWN_FRAMES: Dict[str, bytes] = {
+    fmt: encode({"type": "server_shutdown"}) for fmt, encode in ENCODERS.items()
+}
+
+# 客户端->服务器的二进制协议：单字节ping帧和pong应答，其他二进制帧为MessagePack编码的ClientMessage
+PING_FRAME = b"\x01"
+PONG_FRAME = b"\x02"
+
+class ClientMessage(msgspec.Struct):
+    """客户端发送的消息"""
+    type: str
+
+client_message_decoder = msgspec.msgpack.Decoder(ClientMessage)
+
+# 多worker部署时通过Redis pub/sub在worker之间转发消息的频道
+RELAY_CHANNEL = "imo:ws"
+
+class RelayMessage(msgspec.Struct):
+    """worker之间转发的消息；client_id为None表示广播。消息以dict转发，由持有连接的worker按客户端格式编码"""
+    client_id: Optional[str]
+    message: Dict[str, Any]
+
+_relay_encoder = msgspec.msgpack.Encoder()
+_relay_decoder = msgspec.msgpack.Decoder(RelayMessage)
+
+# 最大连接数，超出时以1013（Try Again Later）关闭新连接
+MAX_CONNECTIONS = int(os.getenv("IMO_WS_MAX", "1000"))
+# 每个客户端待发送队列的容量，队列满说明客户端过慢，以1013关闭连接
+OUTBOUND_QUEUE_SIZE = 1024
+# 写任务一次最多合并发送的消息数
+MAX_BATCH_SIZE = 64
+# 关闭时等待队列中消息发送完毕的最长时间（秒）
+SHUTDOWN_TIMEOUT = 2.0
+
+def _is_connected(websocket: WebSocket) -> bool:
+    """连接双方均未关闭；发送前先判断状态，直接跳过已断开的客户端，避免在发送时抛出并捕获异常"""
+    return (websocket.application_state == WebSocketState.CONNECTED
+            and websocket.client_state == WebSocketState.CONNECTED)
+
 class ConnectionManager:
     """WebSocket连接管理器"""
     
     def __init__(self):
-        # 存储活跃的WebSocket连接
-        self.active_connections: Dict[str, WebSocket] = {}
+        # 活跃连接按结构数组存储：同一下标对应同一客户端的ID、连接、编码格式、待发送队列和写任务
+        self.client_ids: List[str] = []
+        self.sockets: List[WebSocket] = []
+        self.formats: List[str] = []
+        self.queues: List[asyncio.Queue] = []
+        self.writers: List[asyncio.Task] = []
+        # 客户端ID -> 下标
+        self.id_to_index: Dict[str, int] = {}
+        # Redis转发（start_relay后启用），未启用时只向本worker的连接发送
+        self.redis: Optional[aioredis.Redis] = None
+        self._relay_task: Optional[asyncio.Task] = None
+        # 正在关闭的过慢客户端连接（保留引用直到关闭完成）
+        self._closing: set = set()
     
-    async def connect(self, websocket: WebSocket, client_id: str):
-        """接受新的WebSocket连接"""
+    async def connect(self, websocket: WebSocket, client_id: str, fmt: str = DEFAULT_FORMAT) -> bool:
+        """接受新的WebSocket连接，fmt为消息编码格式（json或msgpack）；连接数已满时关闭连接并返回False"""
         await websocket.accept()
-        self.active_connections[client_id] = websocket
-        logger.info(f"Client {client_id} connected. Total connections: {len(self.active_connections)}")
+        if client_id not in self.id_to_index and len(self.client_ids) >= MAX_CONNECTIONS:
+            logger.warning("Rejecting client %s: connection limit %d reached", client_id, MAX_CONNECTIONS)
+            await websocket.close(code=1013)
+            return False
+        # 同一客户端ID重新连接时替换旧连接
+        self.disconnect(client_id)
+        fmt = fmt if fmt in ENCODERS else DEFAULT_FORMAT
+        queue = asyncio.Queue(maxsize=OUTBOUND_QUEUE_SIZE)
+        self.id_to_index[client_id] = len(self.client_ids)
+        self.client_ids.append(client_id)
+        self.sockets.append(websocket)
+        self.formats.append(fmt)
+        self.queues.append(queue)
+        self.writers.append(asyncio.create_task(self._writer_loop(client_id, websocket, fmt, queue)))
+        logger.info("Client %s connected. Total connections: %d", client_id, len(self.client_ids))
         
-        # 发送连接成功消息
-        await self.send_personal_message(
-            json.dumps({
+        # 发送连接成功消息（client_id已由路由按CLIENT_ID_PATTERN校验）
+        if fmt == "json":
+            await self.send_personal_message(_CONNECT_PREFIX + client_id.encode() + _CONNECT_SUFFIX, client_id)
+        else:
+            await self.send_message({
                 "type": "connection",
                 "status": "connected",
                 "client_id": client_id
-            }),
-            client_id
-        )
+            }, client_id)
+        return True
     
-    def disconnect(self, client_id: str):
-        """断开WebSocket连接"""
-        if client_id in self.active_connections:
-            del self.active_connections[client_id]
-            logger.info(f"Client {client_id} disconnected. Remaining connections: {len(self.active_connections)}")
-    
-    async def send_personal_message(self, message: str, client_id: str):
-        """向特定客户端发送消息"""
-        if client_id in self.active_connections:
-            websocket = self.active_connections[client_id]
+    async def start_relay(self, url: str):
+        """连接Redis并订阅转发频道，之后广播和发往其他worker上客户端的消息都经Redis转发"""
+        self.redis = aioredis.from_url(url)
+        pubsub = self.redis.pubsub()
+        await pubsub.subscribe(RELAY_CHANNEL)
+        self._relay_task = asyncio.create_task(self._relay_loop(pubsub))
+        logger.info("Relaying WebSocket messages through Redis channel %s", RELAY_CHANNEL)
+    
+    async def stop_relay(self):
+        """停止转发并关闭Redis连接"""
+        if self._relay_task:
+            self._relay_task.cancel()
             try:
-                await websocket.send_text(message)
-            except Exception as e:
-                logger.error(f"Error sending message to {client_id}: {e}")
-                self.disconnect(client_id)
-    
-    async def broadcast(self, message: str, exclude: List[str] = None):
-        """向所有连接的客户端广播消息"""
-        if exclude is None:
-            exclude = []
-        
-        disconnected_clients = []
-        for client_id, websocket in self.active_connections.items():
-            if client_id not in exclude:
+                await self._relay_task
+            except asyncio.CancelledError:
+                pass
+            self._relay_task = None
+        if self.redis:
+            await self.redis.aclose()
+            self.redis = None
+    
+    async def _relay_loop(self, pubsub):
+        """接收其他worker（包括本worker）发布的消息，发送给本worker持有的连接"""
+        try:
+            async for item in pubsub.listen():
+                if item["type"] != "message":
+                    continue
                 try:
-                    await websocket.send_text(message)
-                except Exception as e:
-                    logger.error(f"Error broadcasting to {client_id}: {e}")
-                    disconnected_clients.append(client_id)
+                    relay = _relay_decoder.decode(item["data"])
+                except msgspec.DecodeError:
+                    logger.warning("Invalid relay message")
+                    continue
+                if relay.client_id is None:
+                    await self.broadcast(relay.message, local_only=True)
+                elif relay.client_id in self.id_to_index:
+                    await self.send_message(relay.message, relay.client_id)
+        finally:
+            await pubsub.aclose()
+    
+    async def publish(self, message: Dict, client_id: Optional[str] = None):
+        """发布到Redis转发频道，由各worker发送给各自持有的连接；client_id为None时广播"""
+        try:
+            await self.redis.publish(RELAY_CHANNEL, _relay_encoder.encode(RelayMessage(client_id, message)))
+        except Exception as e:
+            logger.error("Error publishing WebSocket message to Redis: %s", e)
+    
+    def disconnect(self, client_id: str):
+        """断开WebSocket连接（将最后一个连接移入空出的位置，O(1)删除）"""
+        index = self.id_to_index.pop(client_id, None)
+        if index is None:
+            return
+        writer = self.writers[index]
         
-        # 清理断开的连接
-        for client_id in disconnected_clients:
+        last = len(self.client_ids) - 1
+        if index != last:
+            for column in (self.client_ids, self.sockets, self.formats, self.queues, self.writers):
+                column[index] = column[last]
+            self.id_to_index[self.client_ids[index]] = index
+        for column in (self.client_ids, self.sockets, self.formats, self.queues, self.writers):
+            column.pop()
+        
+        if writer is not asyncio.current_task():
+            writer.cancel()
+        logger.info("Client %s disconnected. Remaining connections: %d", client_id, len(self.client_ids))
+    
+    async def _writer_loop(self, client_id: str, websocket: WebSocket, fmt: str, queue: asyncio.Queue):
+        """
+        按顺序发送客户端队列中的消息
+        
+        队列中积压多条已编码消息时合并为一个 {"type": "batch", "items": [...]} 帧发送；
+        收到None或连接已关闭时结束。已编码的消息用send_bytes发送，不经过文本帧的UTF-8编码
+        """
+        batch_encoder = BATCH_ENCODERS[fmt]
+        # 发送循环中反复调用的方法预先绑定
+        send_bytes = websocket.send_bytes
+        get = queue.get
+        get_nowait = queue.get_nowait
+        empty = queue.empty
+        try:
+            while True:
+                message = await get()
+                if message is None:
+                    return
+                
+                pending = [message]
+                while len(pending) < MAX_BATCH_SIZE and not empty():
+                    pending.append(get_nowait())
+                
+                stop = pending[-1] is None
+                if stop:
+                    pending.pop()
+                
+                if not _is_connected(websocket):
+                    self._disconnect_own(client_id)
+                    return
+                
+                # 连续的已编码消息合并发送，控制帧和文本消息（如pong）单独发送
+                group: List[bytes] = []
+                for item in pending + [None]:
+                    if isinstance(item, bytes) and item is not PONG_FRAME:
+                        group.append(item)
+                        continue
+                    if len(group) == 1:
+                        await send_bytes(group[0])
+                    elif group:
+                        await send_bytes(batch_encoder({
+                            "type": "batch",
+                            "items": [msgspec.Raw(payload) for payload in group]
+                        }))
+                    group = []
+                    if isinstance(item, bytes):
+                        await send_bytes(item)
+                    elif item is not None:
+                        await websocket.send_text(item)
+                
+                if stop:
+                    return
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            # 状态检查与发送之间连接仍可能关闭，异常处理作为最后的保护
+            logger.error("Error sending message to %s: %s", client_id, e)
+            self._disconnect_own(client_id)
+    
+    def _disconnect_own(self, client_id: str):
+        """由写任务调用：客户端可能已用同一ID重新连接，只断开当前写任务所属的连接"""
+        index = self.id_to_index.get(client_id)
+        if index is not None and self.writers[index] is asyncio.current_task():
             self.disconnect(client_id)
     
+    def _drop(self, client_id: str):
+        """
+        移除已断开或过慢的客户端，并以1013（Try Again Later）关闭仍打开的连接
+        
+        关闭后连接端点的receive循环随之结束，前端收到onclose后重新连接
+        """
+        index = self.id_to_index.get(client_id)
+        if index is None:
+            return
+        websocket = self.sockets[index]
+        self.disconnect(client_id)
+        if websocket.application_state == WebSocketState.CONNECTED:
+            close = asyncio.create_task(self._close(client_id, websocket))
+            self._closing.add(close)
+            close.add_done_callback(self._closing.discard)
+    
+    async def _close(self, client_id: str, websocket: WebSocket):
+        """关闭被移除的客户端连接；连接可能已被对方关闭，失败时忽略"""
+        try:
+            await websocket.close(code=1013)
+        except Exception as e:
+            logger.debug("Error closing connection to %s: %s", client_id, e)
+    
+    def _enqueue(self, client_id: str, queue: asyncio.Queue, message: Union[bytes, str]) -> bool:
+        """放入客户端的发送队列；队列已满（客户端过慢）时返回False"""
+        try:
+            queue.put_nowait(message)
+            return True
+        except asyncio.QueueFull:
+            logger.warning("Outbound queue full for client %s, disconnecting slow client", client_id)
+            return False
+    
+    async def send_personal_message(self, message: Union[bytes, str], client_id: str):
+        """向特定客户端发送消息（放入其发送队列）；bytes（已编码的消息）以二进制帧发送，str以文本帧发送"""
+        index = self.id_to_index.get(client_id)
+        if index is None:
+            return
+        if not _is_connected(self.sockets[index]) or not self._enqueue(client_id, self.queues[index], message):
+            self._drop(client_id)
+    
+    async def send_message(self, message: Dict, client_id: str):
+        """按客户端协商的格式编码消息并发送；客户端不在本worker时经Redis转发"""
+        index = self.id_to_index.get(client_id)
+        if index is not None:
+            await self.send_personal_message(ENCODERS[self.formats[index]](message), client_id)
+        elif self.redis:
+            await self.publish(message, client_id)
+    
+    async def send_multi(self, client_id: str, messages: List[Dict]):
+        """
+        一次发送多条消息
+        
+        所有消息编码后连续放入发送队列，写任务将其合并为一个 {"type": "batch", "items": [...]} 帧
+        （每帧最多MAX_BATCH_SIZE条）
+        """
+        index = self.id_to_index.get(client_id)
+        if index is None:
+            for message in messages:
+                await self.send_message(message, client_id)
+            return
+        if not _is_connected(self.sockets[index]):
+            self._drop(client_id)
+            return
+        encode = ENCODERS[self.formats[index]]
+        queue = self.queues[index]
+        for message in messages:
+            if not self._enqueue(client_id, queue, encode(message)):
+                self._drop(client_id)
+                return
+    
+    async def broadcast(self, message: Union[Dict, bytes, str], exclude: List[str] = None, local_only: bool = False):
+        """
+        向所有连接的客户端广播消息（放入各客户端的发送队列，由各自的写任务并发发送）
+        
+        message为dict时按各客户端的编码格式发送，每种格式只编码一次；
+        启用Redis转发时dict消息发布到Redis，由所有worker各自发送（local_only=True时只发给本worker的连接）
+        """
+        if self.redis and not local_only and not exclude and isinstance(message, dict):
+            await self.publish(message)
+            return
+        
+        # 排除的客户端先解析为下标，遍历时只比较整数下标，不再对每个客户端ID做哈希
+        excluded = {self.id_to_index[client_id] for client_id in exclude or () if client_id in self.id_to_index}
+        # 每种编码格式的消息只编码一次，所有客户端共享同一份bytes
+        payloads: Dict[str, Union[bytes, str]] = {}
+        if isinstance(message, dict):
+            for fmt in set(self.formats):
+                payloads[fmt] = ENCODERS[fmt](message)
+        
+        # 已断开或发送队列已满的客户端；循环内用到的方法和列预先绑定到局部变量
+        client_ids = self.client_ids
+        enqueue = self._enqueue
+        payload_for = payloads.get
+        dead_clients = [
+            client_ids[index]
+            for index, (websocket, fmt, queue) in enumerate(zip(self.sockets, self.formats, self.queues))
+            if not (excluded and index in excluded) and (
+                not _is_connected(websocket)
+                or not enqueue(client_ids[index], queue, payload_for(fmt, message))
+            )
+        ]
+        for client_id in dead_clients:
+            self._drop(client_id)
+    
     async def send_agent_update(self, client_id: str, agent_id: int, status: str, data: dict = None):
-        """发送代理状态更新"""
+        """发送代理状态更新（MessagePack客户端直接编码AgentUpdate，不构建dict）"""
+        index = self.id_to_index.get(client_id)
+        if index is not None and self.formats[index] == "msgpack":
+            await self.send_personal_message(_msgpack_encoder.encode(AgentUpdate(
+                MessageType.AGENT_UPDATE, agent_id, status, data or {}
+            )), client_id)
+            return
         message = {
             "type": "agent_update",
             "agent_id": agent_id,
             "status": status,
             "data": data or {}
         }
-        await self.send_personal_message(json.dumps(message), client_id)
+        await self.send_message(message, client_id)
     
     async def send_log(self, client_id: str, agent_id: int, level: str, message: str):
         """发送日志消息"""
@@ -84,7 +405,7 @@ class ConnectionManager:
             "message": message,
             "timestamp": None  # 将在前端添加时间戳
         }
-        await self.send_personal_message(json.dumps(log_message), client_id)
+        await self.send_message(log_message, client_id)
     
     async def send_solution_found(self, client_id: str, agent_id: int, solution: str):
         """发送找到解答的通知"""
@@ -93,7 +414,7 @@ class ConnectionManager:
             "agent_id": agent_id,
             "solution": solution
         }
-        await self.send_personal_message(json.dumps(message), client_id)
+        await self.send_message(message, client_id)
     
     async def send_task_complete(self, client_id: str, stats: dict):
         """发送任务完成通知"""
@@ -101,16 +422,31 @@ class ConnectionManager:
             "type": "task_complete",
             "stats": stats
         }
-        await self.send_personal_message(json.dumps(message), client_id)
+        await self.send_message(message, client_id)
     
     async def disconnect_all(self):
-        """断开所有连接"""
-        for client_id in list(self.active_connections.keys()):
-            await self.send_personal_message(
-                json.dumps({"type": "server_shutdown"}),
-                client_id
-            )
-            self.disconnect(client_id)
+        """通知所有客户端服务器关闭，等待已排队的消息发送完毕（最多SHUTDOWN_TIMEOUT秒）后一次性清空所有连接"""
+        # server_shutdown只通知本worker的连接，预先编码的帧与结束标记一起放入各客户端队列，由写任务并发发送
+        for fmt, queue in zip(self.formats, self.queues):
+            if queue.maxsize - queue.qsize() >= 2:
+                queue.put_nowait(SHUTDOWN_FRAMES[fmt])
+            if not queue.full():
+                queue.put_nowait(None)
+        
+        writers = list(self.writers)
+        if writers:
+            try:
+                await asyncio.wait_for(asyncio.gather(*writers, return_exceptions=True), timeout=SHUTDOWN_TIMEOUT)
+            except asyncio.TimeoutError:
+                logger.warning("Timed out flushing shutdown messages to %d clients", len(writers))
+        
+        # wait_for超时会取消仍在发送的写任务，这里直接清空所有列
+        for writer in writers:
+            writer.cancel()
+        for column in (self.client_ids, self.sockets, self.formats, self.queues, self.writers):
+            column.clear()
+        self.id_to_index.clear()
+        logger.info("All WebSocket connections closed")
 
 # 创建全局管理器实例
 manager = ConnectionManager()
\ No newline at end of file
@@ -1,4 +1,4 @@
-import React, { useState, useEffect } from 'react'
+import React, { useState, useEffect, useRef } from 'react'
 import { Toaster } from 'react-hot-toast'
 import { ProblemInput } from './components/ProblemInput'
 import { AgentGrid } from './components/AgentGrid'
@@ -37,6 +37,9 @@ function App() {
     setShowSolutionModal
   } = useSolverStore()
   
+  // 按代理暂存分片传输中的解答
+  const solutionChunksRef = useRef<Record<number, string[]>>({})
+  
   // WebSocket连接
   const { connected, sendMessage } = useWebSocket({
     url: `ws://localhost:8000/ws/${clientId}`,
@@ -46,8 +49,18 @@ function App() {
         updateAgent(data.agent_id, data.status, data.data)
       } else if (data.type === 'log') {
         addLog(data.agent_id, data.level, data.message)
+      } else if (data.type === 'log_batch') {
+        data.entries.forEach((entry: any) => addLog(data.agent_id, entry.level, entry.message))
       } else if (data.type === 'solution_found') {
         updateAgent(data.agent_id, 'success', { solution: data.solution })
+      } else if (data.type === 'solution_chunk') {
+        const chunks = solutionChunksRef.current[data.agent_id] ?? []
+        chunks[data.seq] = data.data
+        solutionChunksRef.current[data.agent_id] = chunks
+      } else if (data.type === 'solution_end') {
+        const chunks = solutionChunksRef.current[data.agent_id] ?? []
+        delete solutionChunksRef.current[data.agent_id]
+        updateAgent(data.agent_id, 'success', { solution: chunks.join('') })
       } else if (data.type === 'task_complete') {
         setTaskComplete(data.stats)
       }
@@ -11,6 +11,8 @@ interface WebSocketOptions {
   maxReconnectAttempts?: number
 }
 
+const textDecoder = new TextDecoder()
+
 export function useWebSocket(options: WebSocketOptions = {}) {
   const {
     url = `ws://localhost:8000/ws/${uuidv4()}`,
@@ -33,6 +35,8 @@ export function useWebSocket(options: WebSocketOptions = {}) {
     }
 
     const ws = new WebSocket(url)
+    // The server sends JSON messages as UTF-8 binary frames
+    ws.binaryType = 'arraybuffer'
     wsRef.current = ws
 
     ws.onopen = () => {
@@ -44,8 +48,14 @@ export function useWebSocket(options: WebSocketOptions = {}) {
 
     ws.onmessage = (event) => {
       try {
-        const data = JSON.parse(event.data)
-        onMessage?.(data)
+        const text = typeof event.data === 'string' ? event.data : textDecoder.decode(event.data)
+        const data = JSON.parse(text)
+        // The server coalesces queued messages into a single batch frame
+        if (data.type === 'batch') {
+          data.items.forEach((item: any) => onMessage?.(item))
+        } else {
+          onMessage?.(data)
+        }
       } catch (error) {
         console.error('Failed to parse WebSocket message:', error)
       }
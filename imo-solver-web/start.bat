@@ -6,7 +6,7 @@ REM Check if Python is installed
 python --version >nul 2>&1
 if errorlevel 1 (
     echo Error: Python is not installed or not in PATH
-    echo Please install Python 3.8+ from https://www.python.org/
+    echo Please install Python 3.10+ from https://www.python.org/
     pause
     exit /b 1
 )
@@ -6,7 +6,7 @@ echo ""
 # Check if Python is installed
 if ! command -v python3 &> /dev/null; then
     echo "Error: Python 3 is not installed"
-    echo "Please install Python 3.8+ from https://www.python.org/"
+    echo "Please install Python 3.10+ from https://www.python.org/"
     exit 1
 fi
 